@@ -7,6 +7,12 @@ from util.helper import singleton
 
 CHDbConfig = namedtuple('DbConfig', ['host', 'port', 'user', 'password', 'database'])
 
+def get_batch_settings(settings, index):
+    """ insert settings of the nth batch of a split insert, every batch gets its own deduplication token """
+    if not settings or 'insert_deduplication_token' not in settings:
+        return settings
+    return {**settings, 'insert_deduplication_token': f"{settings['insert_deduplication_token']}:{index}"}
+
 
 # noinspection SqlDialectInspection
 class ClickhouseHelper:
@@ -25,16 +31,18 @@ class ClickhouseHelper:
     def execute(self, query, params=None, **kwargs):
         return self.client.execute(query, params, **kwargs)
 
-    def insert(self, document, table, columns=None):
+    def insert(self, document, table, columns=None, settings=None):
         columns_str = ','.join(list(columns))
         insert_query = f'INSERT INTO {table} {"" if columns == "" else f"({columns_str})"} VALUES'
-        return self.client.execute(insert_query, document)
+        return self.client.execute(insert_query, document, settings=settings)
 
-    def bulk_insert(self, documents, table, columns=None, batch_size=10000):
+    def bulk_insert(self, documents, table, columns=None, batch_size=10000, settings=None):
+        if len(documents) <= batch_size:
+            return self.insert(documents, table, columns, settings) if len(documents) > 0 else 0
         rows_inserted = 0
         for i in range(0, len(documents), batch_size):
             subset = documents[i:i + batch_size]
-            rows_inserted += self.insert(subset, table, columns)
+            rows_inserted += self.insert(subset, table, columns, get_batch_settings(settings, i // batch_size))
         return rows_inserted
 
     def insert_dict(self, document, table):
@@ -44,9 +52,32 @@ class ClickhouseHelper:
         insert_query = f'INSERT INTO {table} {"" if columns == "" else f"({columns_str})"} VALUES'
         return self.client.execute(insert_query, [value])
 
-    def bulk_dict_doc_insert(self, documents, table, columns, batch_size=10000):
+    def bulk_dict_doc_insert(self, documents, table, columns, batch_size=10000, settings=None):
         documents_ordered = [[document[column] for column in columns] for document in documents]
-        return self.bulk_insert(documents_ordered, table, columns, batch_size)
+        return self.bulk_insert(documents_ordered, table, columns, batch_size, settings)
+
+    def columnar_insert(self, columns, table, settings=None):
+        """ columns is a dict of the column values, inserted without transposing to rows """
+        insert_query = f'INSERT INTO {table} ({",".join(columns.keys())}) VALUES'
+        self.client.execute(insert_query, list(columns.values()), columnar=True, settings=settings)
+        return len(next(iter(columns.values())))
+
+    def bulk_columnar_insert(self, columns, table, batch_size=10000, settings=None):
+        rows = len(next(iter(columns.values()))) if len(columns) > 0 else 0
+        if rows <= batch_size:
+            return self.columnar_insert(columns, table, settings) if rows > 0 else 0
+        rows_inserted = 0
+        for i in range(0, rows, batch_size):
+            batch = {column: values[i:i + batch_size] for column, values in columns.items()}
+            rows_inserted += self.columnar_insert(batch, table, get_batch_settings(settings, i // batch_size))
+        return rows_inserted
+
+    def get_max_active_parts(self, database, table):
+        """ active parts of the table partition having the most of them """
+        query = ('SELECT max(parts) FROM (SELECT count() AS parts FROM system.parts WHERE database = %(database)s AND '
+                 'table = %(table)s AND active GROUP BY partition)')
+        result = self.execute(query, {'database': database, 'table': table})
+        return result[0][0] if len(result) > 0 and result[0][0] else 0
 
     def remove_doc_by_key(self, table, key, value):
         query = f'ALTER TABLE {table} WHERE {key}={value}'
@@ -1,6 +1,9 @@
+import atexit
 import logging.config
+import logging.handlers
 import os
 import pathlib
+import queue
 from pathlib import Path
 
 import colorlog
@@ -39,13 +42,57 @@ def load_logger_configuration(base_path, log_path):
         return config
 
 
-def initialize_logger(mode, log_path, use_colors) -> logging.Logger:
-    base_path = Path(__file__).parent
+# log path and queue listener of the configured loggers by mode
+configured_loggers = {}
+# a worker process logs to its own directory under the log path, the rotation of the files is not safe across
+# processes
+process_log_name = None
+
+
+def stop_listener(mode):
+    _, listener = configured_loggers.pop(mode, (None, None))
+    if listener:
+        listener.stop()
+
+
+def attach_queue_listener(logger: logging.Logger):
+    """ moves the handlers of the logger behind a queue, the records are written from the listener thread """
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *logger.handlers, respect_handler_level=True)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener.start()
+    return listener
+
+
+def set_process_log_name(name):
+    global process_log_name
+    process_log_name = name
+
+
+def stop_listeners():
+    for mode in list(configured_loggers.keys()):
+        stop_listener(mode)
+
+
+def initialize_logger(mode, log_path, use_colors, asynchronous=False) -> logging.Logger:
     logger = logging.getLogger(mode)
+    if process_log_name:
+        log_path = Path(log_path).joinpath(process_log_name)
+    # configure again only when the log path changes
+    if mode in configured_loggers and configured_loggers[mode][0] == str(log_path):
+        return logger
+    stop_listener(mode)
+    base_path = Path(__file__).parent
     attach_document_logger(logger)
     config = load_logger_configuration(base_path, log_path)
     create_log_directory(log_path)
     logging.config.dictConfig(config)
     if use_colors:
         logger.addHandler(color_console_handler())
+    configured_loggers[mode] = (str(log_path), attach_queue_listener(logger) if asynchronous else None)
     return logger
+
+
+atexit.register(stop_listeners)
@@ -1,6 +1,11 @@
+import time
+
 import orjson
 # noinspection PyPackageRequirements,PyProtectedMember
-from kafka import KafkaConsumer
+from kafka import KafkaConsumer, KafkaAdminClient, ConsumerRebalanceListener
+# noinspection PyPackageRequirements
+from kafka.structs import OffsetAndMetadata
+from redis.exceptions import RedisError
 
 
 def connect_consumer(**kwargs):
@@ -8,25 +13,131 @@ def connect_consumer(**kwargs):
 
 
 def json_decode(obj):
-    return orjson.loads(obj.decode('utf-8'))
+    # orjson reads the utf-8 bytes as they are, tombstones have no value
+    return orjson.loads(obj) if obj is not None else None
+
+
+def custom_connect_consumer(host, port, topic, group, listener=None):
+    if listener is None:
+        return KafkaConsumer(
+            topic,
+            group_id=group,
+            bootstrap_servers=f'{host}:{port}',
+            auto_offset_reset='earliest',
+            enable_auto_commit=False,
+            value_deserializer=json_decode,
+        )
+    return connect_shared_consumer(host, port, [topic], group, listener)
 
 
-def custom_connect_consumer(host, port, topic, group):
-    return KafkaConsumer(
-        topic,
+def connect_shared_consumer(host, port, topics, group, listener):
+    consumer = KafkaConsumer(
         group_id=group,
         bootstrap_servers=f'{host}:{port}',
         auto_offset_reset='earliest',
         enable_auto_commit=False,
         value_deserializer=json_decode,
     )
+    listener.consumer = consumer
+    consumer.subscribe(topics=topics, listener=listener)
+    return consumer
+
+
+def get_group_offsets(host, port, groups):
+    """ committed offsets of the consumer groups named by their topic """
+    admin = KafkaAdminClient(bootstrap_servers=f'{host}:{port}')
+    try:
+        offsets = {}
+        for group in groups:
+            for partition, offset in admin.list_consumer_group_offsets(group_id=group).items():
+                if partition.topic == group and offset.offset >= 0:
+                    offsets[partition] = offset.offset
+        return offsets
+    finally:
+        admin.close()
+
+
+def get_topic_partition_count(host, port, topic):
+    """ number of the partitions of the topic, None when the topic is not created yet """
+    consumer = KafkaConsumer(bootstrap_servers=f'{host}:{port}')
+    try:
+        partitions = consumer.partitions_for_topic(topic)
+        return len(partitions) if partitions else None
+    finally:
+        consumer.close()
+
+
+def get_offset_metadata(offset):
+    # the leader epoch field is not present in the older clients
+    return OffsetAndMetadata(*(offset, '', -1)[:len(OffsetAndMetadata._fields)])
+
+
+class OffsetMigrationListener(ConsumerRebalanceListener):
+    """ assigned partitions without committed offset in the group start from the given offsets """
+
+    def __init__(self, offsets, on_revoked=None):
+        self.consumer = None
+        self.offsets = offsets
+        self.on_revoked = on_revoked
+
+    def on_partitions_revoked(self, revoked):
+        if self.on_revoked:
+            self.on_revoked(set(revoked))
+
+    def on_partitions_assigned(self, assigned):
+        for partition in assigned:
+            if partition in self.offsets and self.consumer.committed(partition) is None:
+                self.consumer.seek(partition, self.offsets[partition])
+
+
+class LagTracker:
+    """
+        lag of every assigned partition from the fetch position and the high-water mark cached by the consumer,
+        without broker requests. the end offsets of the partitions without a high-water mark yet are requested at
+        most every refresh_interval seconds, the lags are published to the {name}:lag redis hash as often. a failed
+        publish is logged and retried on the next interval
+    """
+
+    def __init__(self, consumer: KafkaConsumer, refresh_interval=60, redis=None, name=None, logging=None):
+        self.consumer = consumer
+        self.refresh_interval = refresh_interval
+        self.redis = redis
+        self.name = name
+        self.logging = logging
+        self.end_offsets = {}
+        self.refreshed = None
+        self.published = None
+
+    def is_due(self, last):
+        return last is None or time.monotonic() - last >= self.refresh_interval
+
+    def lags(self):
+        partitions = self.consumer.assignment()
+        missing = [partition for partition in partitions if self.consumer.highwater(partition) is None]
+        if len(missing) > 0 and self.is_due(self.refreshed):
+            self.end_offsets.update(self.consumer.end_offsets(missing))
+            self.refreshed = time.monotonic()
+        lags = {}
+        for partition in partitions:
+            highwater = self.consumer.highwater(partition)
+            end_offset = highwater if highwater is not None else self.end_offsets.get(partition)
+            if end_offset is not None:
+                lags[partition] = max(end_offset - self.consumer.position(partition), 0)
+        if self.redis and self.name and len(lags) > 0 and self.is_due(self.published):
+            self.publish(lags)
+        return lags
 
+    def publish(self, lags):
+        self.published = time.monotonic()
+        try:
+            self.redis.client.hset(f'{self.name}:lag', mapping={f'{partition.topic}:{partition.partition}': lag for
+                                                                 partition, lag in lags.items()})
+        except RedisError as e:
+            if self.logging:
+                self.logging.error(f'unable to publish the lag of {self.name}: {e}')
 
-def all_messages_consumed(consumer: KafkaConsumer):
-    partitions = list(consumer.assignment())
-    if len(partitions) < 1:
-        return False
-    last_commit = consumer.committed(partitions[0])
-    last_offset = consumer.end_offsets(partitions=partitions)
-    last_offset = list(last_offset.values())[0]
-    return last_commit == last_offset
+    def is_consumed(self):
+        """ all the assigned partitions are consumed up to their end """
+        partitions = self.consumer.assignment()
+        lags = self.lags()
+        return len(partitions) > 0 and len(lags) == len(partitions) and sum(lags.values()) < 1
@@ -0,0 +1,94 @@
+import traceback
+from typing import Optional
+
+# noinspection PyPackageRequirements
+from kafka import KafkaAdminClient
+# noinspection PyPackageRequirements
+from kafka.admin import NewTopic
+# noinspection PyPackageRequirements
+from kafka.errors import TopicAlreadyExistsError
+
+from replication.producer.reader import json_encode, key_encode
+from replication.producer.writer import LogWriter
+
+
+def get_dead_letter_topic(topic):
+    return f'{topic}-dlq'
+
+
+def create_dead_letter_topic(host, port, topic):
+    admin_client = KafkaAdminClient(bootstrap_servers=f'{host}:{port}')
+    try:
+        admin_client.create_topics([NewTopic(name=get_dead_letter_topic(topic), num_partitions=1,
+                                             replication_factor=1)])
+    except TopicAlreadyExistsError:
+        pass
+    finally:
+        admin_client.close()
+
+
+def get_dead_letters(partition, errors, offsets):
+    """ dead letters of the (document, error) of the failed documents, offsets maps the document ids to offsets """
+    return [{'doc': document, 'error': str(error), 'partition': partition, 'offset': offsets.get(id(document))} for
+            document, error in errors]
+
+
+def transform_dead_letters(transformer, letters, columnar=False):
+    """ documents (or columns in columnar mode) of the dead letters, and the letters that failed again """
+    documents = [letter['doc'] for letter in letters]
+    failed = {}
+    if columnar:
+        transformed, errors = transformer(documents)
+        failed = {id(document): error for document, error in errors}
+    else:
+        transformed = []
+        for document in documents:
+            # noinspection PyBroadException
+            try:
+                transformed.append(transformer(document))
+            except Exception:
+                failed[id(document)] = traceback.format_exc()
+    return transformed, [{**letter, 'error': failed[id(letter['doc'])]} for letter in letters if
+                         id(letter['doc']) in failed]
+
+
+class DeadLetterWriter:
+    """
+        publishes the documents that failed the transform to the dead-letter topic of the collection, with the error,
+        partition and offset of them. the write waits for kafka, so a batch is committed only after its dead letters.
+        the kafka producer is connected on the first dead letter
+    """
+
+    def __init__(self, connect_writer, topic):
+        self.connect_writer = connect_writer
+        self.log_writer: Optional[LogWriter] = None
+        self.topic = get_dead_letter_topic(topic)
+
+    def write(self, letters, timeout=30):
+        if len(letters) < 1:
+            return 0
+        if self.log_writer is None:
+            self.log_writer = self.connect_writer()
+        futures = [self.log_writer.write(self.topic, letter, key=letter['doc'].get('_key')) for letter in letters]
+        self.log_writer.flush()
+        for future in futures:
+            future.get(timeout=timeout)
+        return len(futures)
+
+    def publish(self, partition, errors, offsets):
+        if len(errors) < 1:
+            return 0
+        return self.write(get_dead_letters(partition, errors, offsets))
+
+    def close(self):
+        if self.log_writer:
+            self.log_writer.close()
+            self.log_writer = None
+
+
+def get_dead_letter_writer(kafka_config, topic):
+    """ writer of the dead-letter topic, the topic is created once per collection by create_dead_letter_topic """
+    def connect_writer():
+        return LogWriter(kafka_config['host'], kafka_config['port'], key_encode, json_encode)
+
+    return DeadLetterWriter(connect_writer, topic)
@@ -1,27 +1,35 @@
 import os
 import pathlib
+import queue
 import signal
 import threading
 import time
 import traceback
 from datetime import datetime
 
+# noinspection PyPackageRequirements
+from kafka.errors import CommitFailedError
+
 from cache.connect import RedisHelper, get_singleton_redis_client, get_redis_client
 from clickhouse.connect import get_ch_client_with_dict_config
-from replication.consumer.broker import custom_connect_consumer, all_messages_consumed
+from replication.consumer.broker import custom_connect_consumer, connect_shared_consumer, get_group_offsets, \
+    get_offset_metadata, OffsetMigrationListener, LagTracker, get_topic_partition_count
+from replication.consumer.dead_letter import get_dead_letter_writer, create_dead_letter_topic
 from replication.consumer.task import Task
-from replication.consumer.transformer import convert_to_ch_dict_using_schema
+from replication.consumer.transformer import compile_schema, compile_columnar_schema
 from replication.producer.reader import LogOpTypes
-from replication.schema.helper import get_table_map_by_arango_collection, create_buffer_table
-from util.basic_utils import get_basic_utilities, CONFIG, LOGGER, SMTP_CLIENT, prepare_logger
-from util.common import get_supported_consumers
+from replication.producer.tick_index import get_tick_offsets
+from replication.schema.helper import get_table_map_by_arango_collection, create_buffer_table, get_topic_partitions
+from util.basic_utils import get_basic_utilities, CONFIG, LOGGER, SMTP_CLIENT, prepare_logger, \
+    is_logger_asynchronous
+from util.common import get_supported_consumers, get_shared_consumers, SHARED_CONSUMER
 
 
 def get_logger():
     config, logging = get_basic_utilities().get_utils((CONFIG, LOGGER))
     if 'logs_path' in config['logs']:
         logs_path = str(pathlib.Path(config['logs']['logs_path']).joinpath('consumer'))
-        return prepare_logger(logs_path, os.getenv('env'))
+        return prepare_logger(logs_path, os.getenv('env'), is_logger_asynchronous(config))
     return logging
 
 
@@ -30,143 +38,930 @@ def get_initial_tick_of_consumer(redis_helper: RedisHelper, consumer_name):
     return redis_helper.client.get(last_tick)
 
 
-def bulk_insert_documents(client, table, documents):
+def bulk_insert_documents(client, table, documents, settings=None):
     if len(documents) > 0:
         columns = list(documents[0].keys())
-        return client.bulk_dict_doc_insert(documents, table, columns)
+        return client.bulk_dict_doc_insert(documents, table, columns, settings=settings)
     return 0
 
 
-def transform_documents(schema, documents):
+def bulk_insert_columns(client, table, columns, settings=None):
+    return client.bulk_columnar_insert(columns, table, settings=settings)
+
+
+def transform_documents(transformer, documents):
     clickhouse_documents = []
     errors = []
     for doc in documents:
         # noinspection PyBroadException
         try:
-            clickhouse_documents.append(convert_to_ch_dict_using_schema(schema, doc))
+            clickhouse_documents.append(transformer(doc))
         except Exception:
             errors.append((doc, traceback.format_exc()))
     return clickhouse_documents, errors
 
 
-def filter_tombstone_messages(records):
-    return [r for r in records if r['doc'] is not None]
+# version from the wal tick is monotonic across the topic partitions, the kafka offset only within a partition
+def pre_process(initial_tick, records, version_from_tick=False):
+    """
+        drops the tombstones and the documents before the initial tick, and returns the data of the rest with the
+        _ver and _deleted attributes in a single pass over the (offset, doc) records
+    """
+    initial_tick = int(initial_tick) if initial_tick else None
+    # the offset version is prefixed by the date of the batch
+    version_prefix = datetime.utcnow().strftime('%Y%j')
+    remove_type = LogOpTypes.REMOVE_DOCUMENT
+    documents = []
+    for offset, doc in records:
+        if doc is None:
+            continue
+        # the tick is parsed only when it is compared or used as the version
+        tick = int(doc['tick']) if initial_tick is not None or version_from_tick else None
+        if initial_tick is not None and tick < initial_tick:
+            continue
+        data = doc['data']
+        data['_ver'] = tick if version_from_tick else int(f'{version_prefix}{offset}')
+        data['_deleted'] = 1 if doc['type'] == remove_type else 0
+        documents.append(data)
+    return documents
 
 
-def filter_relevant_docs(initial_tick, documents):
-    filtered_documents = []
-    for doc in documents:
-        if int(doc['tick']) >= int(initial_tick):
-            filtered_documents.append(doc)
-    return filtered_documents
-
+def pre_process_documents(initial_tick, records, version_from_tick=False):
+    return pre_process(initial_tick, ((r['offset'], r['doc']) for r in records), version_from_tick)
 
-def pre_process_documents(initial_tick, records):
-    records = filter_tombstone_messages(records)
 
-    # pick only required attributes
-    documents = [{**r['doc'], 'offset': r['offset']} for r in records]
+def pre_process_records(initial_tick, messages, version_from_tick=False):
+    """ pre-processes the kafka records as they are polled """
+    return pre_process(initial_tick, ((m.offset, m.value) for m in messages), version_from_tick)
 
-    # filter documents that have tick < initial tick
-    if initial_tick:
-        documents = filter_relevant_docs(initial_tick, documents)
 
-    # append document type
+def coalesce_documents(documents):
+    """ keeps only the latest revision of every _key, tables are ReplacingMergeTree by _ver """
+    latest = {}
     for document in documents:
-        document['data']['_ver'] = int(f"{datetime.utcnow().strftime('%Y%j')}{document['offset']}")
-        document['data']['_deleted'] = 1 if document['type'] == LogOpTypes.REMOVE_DOCUMENT else 0
+        latest.pop(document['_key'], None)
+        latest[document['_key']] = document
+    return list(latest.values())
 
-    return [doc['data'] for doc in documents]
 
+def log_processed_documents(logging, worker_name, keys, versions, audit=('all', 100)):
+    """ audit log of the inserted documents, all: every document, sample: every nth document, summary: one line """
+    audit_mode, sample = audit
+    if audit_mode == 'all':
+        for key, version in zip(keys, versions):
+            logging.info(f'{worker_name}: processed: {key}, ver: {version}')
+    elif audit_mode == 'sample':
+        for key, version in zip(keys[::sample], versions[::sample]):
+            logging.info(f'{worker_name}: processed: {key}, ver: {version}')
+    elif audit_mode == 'summary' and len(keys) > 0:
+        logging.info(f'{worker_name}: processed {len(keys)} docs: {keys[0]}...{keys[-1]}, '
+                     f'ver: {min(versions)}-{max(versions)}')
 
-def log_error_documents(error_documents):
-    logging = get_logger()
-    for error in error_documents:
-        logging.document(f'doc: {error[0]}')
-        logging.document(f'error: {error[1]}')
 
+def log_error_documents(logging, error_documents, audit=('all', 100)):
+    """ document log of the failed documents, by the audit mode of the processed documents """
+    audit_mode, sample = audit
+    if audit_mode == 'off' or len(error_documents) < 1:
+        return
+    if audit_mode == 'summary':
+        logging.document(f'{len(error_documents)} failed docs, first doc: {error_documents[0][0]}')
+        logging.document(f'error: {error_documents[0][1]}')
+        return
+    for document, error in error_documents[::sample] if audit_mode == 'sample' else error_documents:
+        logging.document(f'doc: {document}')
+        logging.document(f'error: {error}')
 
-def data_consumer(consumer_name, stop_event: threading.Event):
+
+def subscribe_wal_notifications(redis_helper: RedisHelper, topics, wake_event: threading.Event):
+    def on_notification(_):
+        wake_event.set()
+
+    return redis_helper.subscribe({f'{topic}:wal': on_notification for topic in topics})
+
+
+def wait_for_wake(stop_event: threading.Event, wake_event: threading.Event, timeout, wait_slice=.1):
+    """ waits for the timeout, a publish notification or the stop event. returns True when woken """
+    wait_until = time.monotonic() + timeout
+    while not stop_event.is_set() and not wake_event.is_set():
+        remaining = wait_until - time.monotonic()
+        if remaining <= 0:
+            break
+        wake_event.wait(timeout=min(wait_slice, remaining))
+    woken = wake_event.is_set()
+    wake_event.clear()
+    return woken
+
+
+def get_deduplication_token(partition, first_offset, last_offset):
+    return f'{partition.topic}:{partition.partition}:{first_offset}-{last_offset}'
+
+
+def get_range_field(partition):
+    return f'{partition.topic}:{partition.partition}'
+
+
+class InsertRanges:
+    """
+        offset ranges of the inserts of the partitions which are not committed yet, kept in the {consumer}:insert-ranges
+        redis hash. a range is stored before its insert and dropped once its offsets are committed. after a restart
+        the records of a partition are held until its stored ranges are polled again, and every range is inserted
+        again as it was, so clickhouse drops the repeated inserts by their deduplication token. records held longer
+        than hold_timeout seconds (the end of a range is compacted away) are released as new ranges. the ranges are
+        stored by the insert thread and trimmed by the polling thread in the pipeline mode
+    """
+
+    def __init__(self, redis_helper: RedisHelper, name, hold_timeout=60):
+        self.redis = redis_helper
+        self.key = f'{name}:insert-ranges'
+        self.hold_timeout = hold_timeout
+        self.lock = threading.Lock()
+        self.ranges = {}
+        self.recovering = {}
+        self.held = {}
+
+    def load(self, partition):
+        stored = self.redis.client.hget(self.key, get_range_field(partition))
+        stored = stored.decode() if isinstance(stored, bytes) else stored
+        if not stored:
+            return []
+        return [tuple(int(offset) for offset in offset_range.split('-')) for offset_range in stored.split(',')]
+
+    def save(self, partition):
+        # called with the lock held
+        self.redis.client.hset(self.key, mapping={get_range_field(partition): ','.join(
+            f'{first_offset}-{last_offset}' for first_offset, last_offset in self.ranges[partition])})
+
+    def store(self, partition, first_offset, last_offset):
+        """ insert settings of the offset range """
+        with self.lock:
+            ranges = self.ranges.setdefault(partition, [])
+            if (first_offset, last_offset) not in ranges:
+                ranges.append((first_offset, last_offset))
+                self.save(partition)
+        return {'insert_deduplicate': 1,
+                'insert_deduplication_token': get_deduplication_token(partition, first_offset, last_offset)}
+
+    def trim(self, partition, offset):
+        """ drops the ranges committed up to the offset """
+        with self.lock:
+            ranges = self.ranges.get(partition, [])
+            uncommitted = [offset_range for offset_range in ranges if offset_range[1] >= offset]
+            if len(uncommitted) != len(ranges):
+                self.ranges[partition] = uncommitted
+                self.save(partition)
+
+    def recover(self, partition, messages):
+        """
+            the batches of the stored ranges and the rest of the messages. nothing is returned while the messages of
+            the partition are held for its stored ranges
+        """
+        if partition not in self.recovering:
+            with self.lock:
+                if partition in self.ranges:
+                    return [], messages
+                # the stored ranges from the polled position
+                ranges = [offset_range for offset_range in self.load(partition) if
+                          offset_range[0] >= messages[0].offset]
+                self.ranges[partition] = list(ranges)
+            if len(ranges) < 1:
+                return [], messages
+            self.recovering[partition] = (ranges, time.monotonic())
+            held = []
+        else:
+            held = self.held.pop(partition)
+            # the partition is polled again from the committed offset after a rebalance
+            if messages[0].offset <= held[-1].offset:
+                held = []
+        held = held + list(messages)
+        ranges, since = self.recovering[partition]
+        if held[-1].offset < ranges[-1][1]:
+            if time.monotonic() - since < self.hold_timeout:
+                self.held[partition] = held
+                return [], []
+            del self.recovering[partition]
+            return [], held
+        del self.recovering[partition]
+        batches = [[message for message in held if first_offset <= message.offset <= last_offset] for
+                   first_offset, last_offset in ranges]
+        rest = [message for message in held if not any(
+            first_offset <= message.offset <= last_offset for first_offset, last_offset in ranges)]
+        return [batch for batch in batches if len(batch) > 0], rest
+
+
+class TableConsumer:
+    """ transforms and inserts the kafka records of a table into clickhouse """
+
+    def __init__(self, consumer_name, table_map, ch_table, initial_tick, config):
+        consumer_config = config['consumer']
+        self.consumer_name = consumer_name
+        self.table_map = table_map
+        self.ch_table = ch_table
+        self.initial_tick = initial_tick
+        self.primary_key = table_map['schema']['primary_key']
+        # columnar transform and insert skip the per row dicts
+        self.columnar = config['clickhouse'].get('columnar', False)
+        self.transformer = compile_columnar_schema(table_map['schema']) if self.columnar else compile_schema(
+            table_map['schema'])
+        self.version_from_tick = get_topic_partitions(table_map) > 1 or consumer_config.get('version') == 'tick'
+        self.coalesce = consumer_config.get('coalesce', False)
+        self.audit = (consumer_config.get('audit', 'all'), consumer_config.get('audit_sample', 100))
+        self.ch_client = get_ch_client_with_dict_config(config['clickhouse'])
+        # failed documents are published to the {consumer}-dlq topic, to be replayed once the schema is fixed
+        self.dead_letter = get_dead_letter_writer(config['kafka'], consumer_name) if consumer_config.get(
+            'dlq', False) else None
+        # inserts are deduplicated by the topic, partition and offset range of them
+        redis_config = config['redis']
+        self.insert_ranges = InsertRanges(get_singleton_redis_client(
+            redis_config['host'], redis_config['port'], redis_config['db']), consumer_name) if consumer_config.get(
+            'deduplicate', False) else None
+        # partitions which already reached the initial tick
+        self.relevant_partitions = set()
+
+    def transform(self, worker_name, partition, messages, logging):
+        """ clickhouse documents of the records, or the columns of them in columnar mode """
+        partition_tick = None if partition in self.relevant_partitions else self.initial_tick
+        documents = pre_process_records(partition_tick, messages, self.version_from_tick)
+
+        # skip initial tick validation once the partition reached the initial tick
+        if len(documents) > 0:
+            self.relevant_partitions.add(partition)
+
+        if self.coalesce:
+            documents_count = len(documents)
+            documents = coalesce_documents(documents)
+            if documents_count > len(documents):
+                logging.info(f'{worker_name}: coalesced {documents_count - len(documents)} docs')
+
+        if self.columnar:
+            # transform the documents by columns
+            columns, errors = self.transformer(documents)
+            self.reject(partition, messages, errors, logging)
+            return columns
+
+        # transform the documents
+        documents, errors = transform_documents(self.transformer, documents)
+        self.reject(partition, messages, errors, logging)
+        return documents
+
+    def reject(self, partition, messages, errors, logging):
+        """ logs the failed documents, and publishes them to the dead-letter topic when enabled """
+        log_error_documents(logging, errors, self.audit)
+        if self.dead_letter and len(errors) > 0:
+            # the documents are the data of the record values
+            offsets = {id(message.value['data']): message.offset for message in messages if message.value is not None}
+            self.dead_letter.publish(partition.partition, errors, offsets)
+
+    def recover(self, partition, messages):
+        """ the batches inserted before a restart, to be inserted again as they were, and the rest of the messages """
+        if self.insert_ranges is None:
+            return [], messages
+        return self.insert_ranges.recover(partition, messages)
+
+    def get_insert_settings(self, partition, first_offset, last_offset):
+        if self.insert_ranges is None:
+            return None
+        return self.insert_ranges.store(partition, first_offset, last_offset)
+
+    def committed(self, offsets):
+        """ drops the insert ranges of the committed offsets """
+        if self.insert_ranges is None:
+            return
+        for partition, offset in offsets.items():
+            self.insert_ranges.trim(partition, offset.offset)
+
+    def insert(self, worker_name, transformed, logging, settings=None):
+        if self.columnar:
+            processed_count = bulk_insert_columns(self.ch_client, self.ch_table, transformed, settings)
+            log_processed_documents(logging, worker_name, transformed[self.primary_key], transformed['_ver'],
+                                    self.audit)
+        else:
+            processed_count = bulk_insert_documents(self.ch_client, self.ch_table, transformed, settings)
+
+            # log the documents
+            if self.audit[0] != 'off':
+                log_processed_documents(logging, worker_name, [document[self.primary_key] for document in transformed],
+                                        [document['_ver'] for document in transformed], self.audit)
+
+        logging.info(f'{worker_name}: processed {processed_count} docs')
+        return processed_count
+
+    def close(self):
+        if self.dead_letter:
+            self.dead_letter.close()
+
+    def process_batch(self, worker_name, partition, batch, logging):
+        return self.insert(worker_name, self.transform(worker_name, partition, batch, logging), logging,
+                           self.get_insert_settings(partition, batch[0].offset, batch[-1].offset))
+
+    def process(self, worker_name, partition, messages, logging):
+        """ inserts the messages, returns the offset to commit or None while the messages are held """
+        batches, messages = self.recover(partition, messages)
+        if len(messages) > 0:
+            batches.append(messages)
+        for batch in batches:
+            self.process_batch(worker_name, partition, batch, logging)
+        return max(batch[-1].offset for batch in batches) + 1 if len(batches) > 0 else None
+
+
+def get_rows_count(transformed):
+    if isinstance(transformed, dict):
+        return len(next(iter(transformed.values()))) if len(transformed) > 0 else 0
+    return len(transformed)
+
+
+def merge_transformed(batches):
+    """ one batch of the transformed documents or columns """
+    if len(batches) == 1:
+        return batches[0]
+    if isinstance(batches[0], dict):
+        return {column: [value for batch in batches for value in batch[column]] for column in batches[0]}
+    return [document for batch in batches for document in batch]
+
+
+class InsertAccumulator:
+    """
+        collects the transformed batches of a table and inserts them together once max_rows rows, max_bytes record
+        bytes or max_age seconds are reached. the row and byte thresholds are scaled up (up to max_scale times) while
+        the table has more than max_parts active parts in a partition, and scaled down when an insert takes longer
+        than the target latency
+    """
+
+    def __init__(self, table_consumer: TableConsumer, max_rows=10000, max_bytes=16777216, max_age=5, max_scale=16,
+                 target_latency=2, max_parts=100, parts_interval=30):
+        self.table_consumer = table_consumer
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_scale = max_scale
+        self.target_latency = target_latency
+        self.max_parts = max_parts
+        self.parts_interval = parts_interval
+        self.scale = 1
+        self.parts = 0
+        self.parts_checked = None
+        self.batches = []
+        self.offsets = {}
+        self.first_offsets = {}
+        self.rows = 0
+        self.size = 0
+        self.started = None
+
+    def add(self, partition, offset, transformed, size, first_offset=None):
+        if self.started is None:
+            self.started = time.monotonic()
+        self.batches.append((partition, transformed))
+        self.offsets[partition] = offset
+        self.first_offsets.setdefault(partition, first_offset)
+        self.rows += get_rows_count(transformed)
+        self.size += size
+
+    def is_empty(self):
+        return len(self.offsets) < 1
+
+    def is_ready(self):
+        return not self.is_empty() and (self.rows >= self.max_rows * self.scale or
+                                        self.size >= self.max_bytes * self.scale or
+                                        time.monotonic() - self.started >= self.max_age)
+
+    def flush(self, worker_name, logging):
+        """ inserts the collected batches, returns the offsets to commit """
+        batches = [(partition, batch) for partition, batch in self.batches if get_rows_count(batch) > 0]
+        if len(batches) > 0:
+            insert_started = time.monotonic()
+            if self.table_consumer.insert_ranges is None:
+                self.table_consumer.insert(worker_name, merge_transformed([batch for _, batch in batches]), logging)
+            else:
+                # an insert per partition, deduplicated by the offset range of the partition
+                for partition, offset in self.offsets.items():
+                    partition_batches = [batch for batch_partition, batch in batches if batch_partition == partition]
+                    if len(partition_batches) > 0:
+                        settings = self.table_consumer.get_insert_settings(partition, self.first_offsets[partition],
+                                                                           offset - 1)
+                        self.table_consumer.insert(worker_name, merge_transformed(partition_batches), logging,
+                                                   settings)
+            self.adapt(time.monotonic() - insert_started, worker_name, logging)
+        offsets = {partition: get_offset_metadata(offset) for partition, offset in self.offsets.items()}
+        self.batches, self.offsets, self.first_offsets, self.rows, self.size, self.started = [], {}, {}, 0, 0, None
+        return offsets
+
+    def get_parts(self):
+        now = time.monotonic()
+        if self.parts_checked is None or now - self.parts_checked >= self.parts_interval:
+            table_map = self.table_consumer.table_map
+            self.parts = self.table_consumer.ch_client.get_max_active_parts(table_map['clickhouse_db'],
+                                                                            table_map['clickhouse'])
+            self.parts_checked = now
+        return self.parts
+
+    def adapt(self, latency, worker_name, logging):
+        scale = self.scale
+        if self.get_parts() > self.max_parts:
+            # fewer and larger parts while the merges are behind
+            scale = min(self.scale * 2, self.max_scale)
+        elif latency > self.target_latency:
+            scale = max(self.scale / 2, 1)
+        if scale != self.scale:
+            logging.info(f'{worker_name}: insert batch scale changed: {self.scale} -> {scale}, '
+                         f'parts: {self.parts}, insert latency: {latency:.3f}s')
+            self.scale = scale
+
+
+def get_insert_accumulator(table_consumer: TableConsumer, consumer_config):
+    if not consumer_config.get('accumulate', False):
+        return None
+    return InsertAccumulator(table_consumer, consumer_config.get('accumulate_rows', 10000),
+                             consumer_config.get('accumulate_bytes', 16777216),
+                             consumer_config.get('accumulate_age', 5),
+                             consumer_config.get('accumulate_max_scale', 16),
+                             consumer_config.get('accumulate_target_latency', 2),
+                             consumer_config.get('accumulate_max_parts', 100))
+
+
+def put_item(target: queue.Queue, item, stop_event: threading.Event, poll_interval=.1):
+    while not stop_event.is_set():
+        try:
+            target.put(item, timeout=poll_interval)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_stage(stage, source: queue.Queue, target: queue.Queue, stop_event: threading.Event, poll_interval=.1):
+    """ applies the stage to the (partition, offset, item, error) of the source, a failed item carries its error """
+    while not stop_event.is_set():
+        try:
+            partition, offset, item, error = source.get(timeout=poll_interval)
+        except queue.Empty:
+            continue
+        if error is None:
+            # noinspection PyBroadException
+            try:
+                item = stage(partition, item)
+            except Exception as e:
+                item, error = None, e
+        put_item(target, (partition, offset, item, error), stop_event)
+
+
+class ConsumerPipeline:
+    """
+        transforms and inserts the polled batches in separate threads with bounded queues between the stages. the
+        polling thread hands the batches and commits the offsets of the inserted ones, the batches are held back
+        while the transform queue is full
+    """
+
+    def __init__(self, table_consumer: TableConsumer, worker_name, logging, queue_size=2):
+        self.transform_queue = queue.Queue(maxsize=queue_size)
+        self.insert_queue = queue.Queue(maxsize=queue_size)
+        self.results = queue.Queue()
+        self.pending = []
+        self.in_flight = 0
+        self.revoked = set()
+        self.stop_event = threading.Event()
+
+        self.table_consumer = table_consumer
+
+        def transform(partition, messages):
+            return (table_consumer.transform(worker_name, partition, messages, logging), messages[0].offset,
+                    messages[-1].offset)
+
+        def insert(partition, item):
+            transformed, first_offset, last_offset = item
+            # the range is stored once the previous batches of the partition are inserted
+            return table_consumer.insert(worker_name, transformed, logging,
+                                         table_consumer.get_insert_settings(partition, first_offset, last_offset))
+
+        self.threads = [
+            threading.Thread(target=run_stage, name=f'{worker_name}-transform',
+                             args=(transform, self.transform_queue, self.insert_queue, self.stop_event)),
+            threading.Thread(target=run_stage, name=f'{worker_name}-insert',
+                             args=(insert, self.insert_queue, self.results, self.stop_event)),
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def put(self, partition, messages):
+        self.revoked.discard(partition)
+        batches, messages = self.table_consumer.recover(partition, messages)
+        if len(messages) > 0:
+            batches.append(messages)
+        for batch in batches:
+            self.pending.append((partition, batch[-1].offset + 1, batch, None))
+
+    def hand(self):
+        """ queues the pending batches, returns True while batches are held back """
+        while len(self.pending) > 0 and not self.transform_queue.full():
+            self.transform_queue.put(self.pending.pop(0))
+            self.in_flight += 1
+        return len(self.pending) > 0
+
+    def inserted(self):
+        """ offsets to commit of the inserted batches, the error of a failed batch is raised """
+        offsets = {}
+        while not self.results.empty():
+            partition, offset, _, error = self.results.get()
+            self.in_flight -= 1
+            if error:
+                raise error
+            if partition not in self.revoked:
+                offsets[partition] = get_offset_metadata(offset)
+        return offsets
+
+    def revoke(self, partitions):
+        """ drops the pending batches of the revoked partitions, the batches in flight are not committed """
+        self.pending = [batch for batch in self.pending if batch[0] not in partitions]
+        self.revoked.update(partitions)
+
+    def is_idle(self):
+        return len(self.pending) < 1 and self.in_flight < 1
+
+    def drain(self, timeout=60, poll_interval=.1):
+        """ inserts the pending batches and the batches in flight, returns the offsets to commit of them """
+        offsets, deadline = self.inserted(), time.monotonic() + timeout
+        while not self.is_idle() and time.monotonic() < deadline:
+            self.hand()
+            self.stop_event.wait(timeout=poll_interval)
+            offsets.update(self.inserted())
+        return offsets
+
+    def close(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join()
+
+
+def commit_offsets(consumer, table_consumer: TableConsumer, offsets):
+    consumer.commit(offsets)
+    table_consumer.committed(offsets)
+
+
+def commit_inserted(consumer, table_consumer: TableConsumer, offsets, worker_name, logging):
+    """ commits the offsets of the batches inserted in the background, a failed commit is logged """
+    if len(offsets) < 1:
+        return
+    try:
+        commit_offsets(consumer, table_consumer, offsets)
+    except CommitFailedError as e:
+        # the partitions were reassigned, the new owner consumes them from the last commit
+        logging.error(f'{worker_name}: commit failed: {e}')
+
+
+def consume_partitions(consumer_name, worker_name, table_map, ch_table, initial_tick, stop_event: threading.Event):
     config = get_basic_utilities().get(CONFIG)
     logging = get_logger()
 
-    logging.info(f'{consumer_name} started')
-
-    # initialize necessary config
     kafka_config, consumer_config = config['kafka'], config['consumer']
+    table_consumer = TableConsumer(consumer_name, table_map, ch_table, initial_tick, config)
 
-    # initialize redis
     redis_config = config['redis']
     redis_helper = get_singleton_redis_client(redis_config['host'], redis_config['port'], redis_config['db'])
-    initial_tick = get_initial_tick_of_consumer(redis_helper, consumer_name)
 
-    # initialize clickhouse
-    ch_client = get_ch_client_with_dict_config(config['clickhouse'])
+    # transform and insert run in their own threads in the pipeline mode, started once the consumer is connected
+    pipeline = ConsumerPipeline(table_consumer, worker_name, logging, consumer_config.get(
+        'pipeline_queue_size', 2)) if consumer_config.get('pipeline', False) else None
+
+    # initialize kafka consumer, the partitions of the topic are shared among the consumers of the group. the
+    # partitions without committed offsets start from the tick index checkpoints before the initial tick, the
+    # batches of the revoked partitions are dropped from the pipeline
+    listener = None
+    if (initial_tick and consumer_config.get('tick_index', False)) or pipeline:
+        offsets = {}
+        if initial_tick and consumer_config.get('tick_index', False):
+            offsets = get_tick_offsets(redis_helper, consumer_name, get_topic_partitions(table_map), initial_tick)
+        listener = OffsetMigrationListener(offsets, pipeline.revoke if pipeline else None)
+
+    # the polled batches are inserted together in the accumulate mode
+    accumulator = get_insert_accumulator(table_consumer, consumer_config) if not pipeline else None
+
+    consumer, subscriber = None, None
+    # noinspection PyBroadException
+    try:
+        consumer = custom_connect_consumer(kafka_config['host'], kafka_config['port'], consumer_name, consumer_name,
+                                           listener)
+        idle, max_records, time_out = (consumer_config['idle'], consumer_config['kafka_max_records'],
+                                       consumer_config['kafka_poll_time_out'])
+        # the idle decision and the lag metric of the partitions use the offsets cached by the consumer
+        lag_tracker = LagTracker(consumer, consumer_config.get('lag_refresh_interval', 60), redis_helper,
+                                 consumer_name, logging)
+
+        # the idle consumer is woken by the publish notifications of the producer
+        wake_event = threading.Event()
+        subscriber = subscribe_wal_notifications(redis_helper, [consumer_name], wake_event) if consumer_config.get(
+            'notify', False) else None
+        if pipeline:
+            pipeline.start()
+
+        while not stop_event.is_set():
+            logging.info(f'{worker_name}: polling for messages')
+            msg_pack = consumer.poll(timeout_ms=time_out, max_records=max_records)
+
+            if pipeline:
+                for partition, messages in msg_pack.items():
+                    pipeline.put(partition, messages)
+
+                # fetch no more while the pipeline is full
+                if pipeline.hand():
+                    consumer.pause(*consumer.assignment())
+                elif len(consumer.paused()) > 0:
+                    consumer.resume(*consumer.paused())
+
+                # update offset of the inserted batches in kafka
+                commit_inserted(consumer, table_consumer, pipeline.inserted(), worker_name, logging)
+                is_drained = pipeline.is_idle()
+            elif accumulator:
+                for partition, messages in msg_pack.items():
+                    recovered, messages = table_consumer.recover(partition, messages)
+                    # the batches inserted before the restart are inserted again as they were
+                    for batch in recovered:
+                        table_consumer.process_batch(worker_name, partition, batch, logging)
+                    if len(recovered) > 0 and len(messages) < 1:
+                        commit_offsets(consumer, table_consumer,
+                                       {partition: get_offset_metadata(recovered[-1][-1].offset + 1)})
+                    if len(messages) < 1:
+                        continue
+                    transformed = table_consumer.transform(worker_name, partition, messages, logging)
+                    accumulator.add(partition, messages[-1].offset + 1, transformed,
+                                    sum(message.serialized_value_size for message in messages), messages[0].offset)
+
+                # insert once a threshold is reached or nothing more is polled, then update offset in kafka
+                if accumulator.is_ready() or (len(msg_pack) < 1 and not accumulator.is_empty()):
+                    commit_offsets(consumer, table_consumer, accumulator.flush(worker_name, logging))
+                is_drained = accumulator.is_empty()
+            else:
+                offsets = {}
+                for partition, messages in msg_pack.items():
+                    offset = table_consumer.process(worker_name, partition, messages, logging)
+                    if offset is not None:
+                        offsets[partition] = get_offset_metadata(offset)
+
+                # update offset in kafka, the held messages are not committed
+                if len(offsets) > 0:
+                    commit_offsets(consumer, table_consumer, offsets)
+                is_drained = True
+
+            # idle the process
+            is_messages_consumed = is_drained and lag_tracker.is_consumed()
+            if is_messages_consumed:
+                logging.info(f'{worker_name} process idle')
+                wait_for_wake(stop_event, wake_event, idle)
+
+        # insert the collected batches and the batches in the pipeline before stopping
+        if accumulator and not accumulator.is_empty():
+            commit_offsets(consumer, table_consumer, accumulator.flush(worker_name, logging))
+        if pipeline:
+            commit_inserted(consumer, table_consumer, pipeline.drain(), worker_name, logging)
+
+    except Exception as e:
+        if consumer:
+            consumer.close()
+        raise e
+    finally:
+        if pipeline:
+            pipeline.close()
+        if subscriber:
+            subscriber.stop()
+        table_consumer.close()
+
+
+def get_partition_workers(consumer_name, configured, partitions, logging):
+    """ one worker per partition of the topic, the configured partitions until the topic is created """
+    if partitions is None:
+        return configured
+    if partitions != configured:
+        logging.error(f'{consumer_name}: the topic has {partitions} partitions, {configured} are configured')
+    return partitions
+
+
+def run_partition_workers(consumer_name, workers, args, stop_event: threading.Event, check_interval=1):
+    """ runs one consumer per partition, a failed worker stops the other workers and its error is raised """
+    workers_stop = threading.Event()
+    errors = []
+
+    def run(worker_name):
+        # noinspection PyBroadException
+        try:
+            consume_partitions(consumer_name, worker_name, *args, workers_stop)
+        except Exception as e:
+            errors.append(e)
+            workers_stop.set()
+
+    threads = [threading.Thread(target=run, name=f'{consumer_name}-{index}', args=(f'{consumer_name}[{index}]',))
+               for index in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            if stop_event.is_set():
+                workers_stop.set()
+            thread.join(timeout=check_interval)
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def prepare_table(consumer_name, ch_client, logging):
+    """ table map and the table to insert of the consumer, the buffer table is created when enabled """
     table_map = get_table_map_by_arango_collection(consumer_name)
     if table_map is None:
         logging.error('table map is not available')
-        return False
+        return None, None
 
     use_buffer = 'buffer' in table_map
     ch_table = f"{table_map['clickhouse']}_Buffer" if use_buffer else table_map['clickhouse']
-    primary_key = table_map['schema']['primary_key']
 
     # create buffer table if not present
     if use_buffer:
         created = create_buffer_table(ch_client, table_map['clickhouse_db'], table_map['clickhouse'], table_map)
         if not created:
             logging.error('failed to create buffer table')
-            return False
+            return None, None
 
-    # initialize kafka consumer
-    consumer = custom_connect_consumer(kafka_config['host'], kafka_config['port'], consumer_name, consumer_name)
-    idle, max_records, time_out = (consumer_config['idle'], consumer_config['kafka_max_records'],
-                                   consumer_config['kafka_poll_time_out'])
+    # the dead-letter topic is created once for the workers of the consumer
+    config = get_basic_utilities().get(CONFIG)
+    if config['consumer'].get('dlq', False):
+        create_dead_letter_topic(config['kafka']['host'], config['kafka']['port'], consumer_name)
+    return table_map, ch_table
 
-    # noinspection PyBroadException
-    try:
-        while not stop_event.is_set():
-            logging.info(f'{consumer_name}: polling for messages')
-            msg_pack = consumer.poll(timeout_ms=time_out, max_records=max_records)
 
-            for topic, messages in msg_pack.items():
+def data_consumer(consumer_name, stop_event: threading.Event):
+    config = get_basic_utilities().get(CONFIG)
+    logging = get_logger()
 
-                # _ = handle_messages([m.value for m in messages], consumer_name)
-                documents = [{'offset': m.offset, 'doc': m.value} for m in messages]
-                documents = pre_process_documents(initial_tick, documents)
+    logging.info(f'{consumer_name} started')
 
-                # set to none to skip initial tick validation
-                if len(documents) > 0:
-                    initial_tick = None
+    # initialize redis
+    redis_config = config['redis']
+    redis_helper = get_singleton_redis_client(redis_config['host'], redis_config['port'], redis_config['db'])
+    initial_tick = get_initial_tick_of_consumer(redis_helper, consumer_name)
 
-                # transform the documents
-                documents, errors = transform_documents(table_map['schema'], documents)
-                log_error_documents(errors)
+    # initialize clickhouse
+    ch_client = get_ch_client_with_dict_config(config['clickhouse'])
+    table_map, ch_table = prepare_table(consumer_name, ch_client, logging)
+    if table_map is None:
+        return False
 
-                # insert the documents
-                processed_count = bulk_insert_documents(ch_client, ch_table, documents)
+    # one worker per partition of the topic
+    kafka_config = config['kafka']
+    workers = get_partition_workers(consumer_name, get_topic_partitions(table_map), get_topic_partition_count(
+        kafka_config['host'], kafka_config['port'], consumer_name), logging)
+    args = (table_map, ch_table, initial_tick)
+    if workers > 1:
+        run_partition_workers(consumer_name, workers, args, stop_event)
+    else:
+        consume_partitions(consumer_name, consumer_name, *args, stop_event)
 
-                # log the documents
-                for document in documents:
-                    # logging.debug(f'{consumer_name}: message: {document}')
-                    logging.info(f'{consumer_name}: processed: {document[primary_key]}, ver: {document["_ver"]}')
+    logging.info(f'{consumer_name} exited gracefully')
 
-                logging.info(f'{consumer_name}: processed {processed_count} docs')
 
-            # update offset in kafka
-            consumer.commit()
+def run_table_worker(table_consumer: TableConsumer, batches: queue.Queue, results: queue.Queue,
+                     stop_event: threading.Event, poll_interval=.1):
+    """
+        processes the record batches handed by the shared consumer, results are (partition, offset, error). the
+        offset is None while the records are held to recover the insert ranges
+    """
+    logging = get_logger()
+    while not stop_event.is_set():
+        try:
+            partition, messages = batches.get(timeout=poll_interval)
+        except queue.Empty:
+            continue
+        # noinspection PyBroadException
+        try:
+            offset = table_consumer.process(table_consumer.consumer_name, partition, messages, logging)
+            results.put((partition, offset, None))
+        except Exception as e:
+            logging.error(f'{table_consumer.consumer_name}: failed: {traceback.format_exc()}')
+            results.put((partition, None, e))
 
-            # idle the process
-            is_messages_consumed = all_messages_consumed(consumer)
-            if is_messages_consumed:
-                logging.info(f'{consumer_name} process idle')
-                stop_event.wait(timeout=idle)
 
-    except Exception as e:
-        consumer.close()
-        raise e
+def shared_consumer(consumer_names, stop_event: threading.Event):
+    """
+        consumes the topics of the collections with one kafka consumer, the records are handed to a transform and
+        insert worker per table and the offsets of a topic are committed once its worker inserted them. topics of
+        the busy workers are paused
+    """
+    config = get_basic_utilities().get(CONFIG)
+    logging = get_logger()
+    kafka_config, consumer_config = config['kafka'], config['consumer']
 
-    logging.info(f'{consumer_name} exited gracefully')
+    logging.info(f'{SHARED_CONSUMER} started: {consumer_names}')
+
+    redis_config = config['redis']
+    redis_helper = get_singleton_redis_client(redis_config['host'], redis_config['port'], redis_config['db'])
+    ch_client = get_ch_client_with_dict_config(config['clickhouse'])
+    table_consumers = {}
+    for consumer_name in consumer_names:
+        table_map, ch_table = prepare_table(consumer_name, ch_client, logging)
+        if table_map is None:
+            logging.error(f'{SHARED_CONSUMER}: {consumer_name} skipped')
+            continue
+        initial_tick = get_initial_tick_of_consumer(redis_helper, consumer_name)
+        table_consumers[consumer_name] = TableConsumer(consumer_name, table_map, ch_table, initial_tick, config)
+    if len(table_consumers) < 1:
+        return False
+
+    # one worker per table, the topic of a consumer is named by the consumer. the workers are started once the
+    # consumer is connected
+    queue_size = consumer_config.get('shared_queue_size', 2)
+    batches = {topic: queue.Queue(maxsize=queue_size) for topic in table_consumers}
+    results = queue.Queue()
+    workers_stop = threading.Event()
+    threads = [threading.Thread(target=run_table_worker, name=f'{SHARED_CONSUMER}-{topic}',
+                                args=(table_consumer, batches[topic], results, workers_stop))
+               for topic, table_consumer in table_consumers.items()]
+
+    # batches waiting for a busy worker, batches handed to the workers by topic, and the revoked partitions whose
+    # batches in flight are not committed
+    pending, in_flight, revoked = {}, {topic: 0 for topic in table_consumers}, set()
+
+    def on_revoked(partitions):
+        for topic in list(pending.keys()):
+            pending[topic] = [batch for batch in pending[topic] if batch[0] not in partitions]
+        revoked.update(partitions)
+
+    consumer, subscriber = None, None
+    try:
+        # the partitions without offsets of the shared group start from the offsets of the consumer groups by
+        # topic, or from the tick index checkpoints before the initial tick
+        topics = list(table_consumers.keys())
+        offsets = {}
+        if consumer_config.get('tick_index', False):
+            for topic, table_consumer in table_consumers.items():
+                if table_consumer.initial_tick:
+                    offsets.update(get_tick_offsets(redis_helper, topic, get_topic_partitions(
+                        table_consumer.table_map), table_consumer.initial_tick))
+        offsets.update(get_group_offsets(kafka_config['host'], kafka_config['port'], topics))
+        listener = OffsetMigrationListener(offsets, on_revoked)
+        consumer = connect_shared_consumer(kafka_config['host'], kafka_config['port'], topics, SHARED_CONSUMER,
+                                           listener)
+        idle, max_records, time_out = (consumer_config['idle'], consumer_config['kafka_max_records'],
+                                       consumer_config['kafka_poll_time_out'])
+        lag_tracker = LagTracker(consumer, consumer_config.get('lag_refresh_interval', 60), redis_helper,
+                                 SHARED_CONSUMER, logging)
+        wake_event = threading.Event()
+        subscriber = subscribe_wal_notifications(redis_helper, topics, wake_event) if consumer_config.get(
+            'notify', False) else None
+        for thread in threads:
+            thread.start()
+
+        while not stop_event.is_set():
+            msg_pack = consumer.poll(timeout_ms=time_out, max_records=max_records)
+            for partition, messages in msg_pack.items():
+                revoked.discard(partition)
+                pending.setdefault(partition.topic, []).append((partition, messages))
+
+            # hand the batches to the workers, the topics of the busy workers are paused
+            for topic in list(pending.keys()):
+                while len(pending[topic]) > 0 and not batches[topic].full():
+                    batches[topic].put(pending[topic].pop(0))
+                    in_flight[topic] += 1
+                if len(pending[topic]) < 1:
+                    del pending[topic]
+            busy = {partition for partition in consumer.assignment() if partition.topic in pending}
+            paused = consumer.paused()
+            if len(busy - paused) > 0:
+                consumer.pause(*(busy - paused))
+            if len(paused - busy) > 0:
+                consumer.resume(*(paused - busy))
+
+            # commit the offsets of the inserted batches
+            offsets = {}
+            while not results.empty():
+                partition, offset, error = results.get()
+                in_flight[partition.topic] -= 1
+                if error:
+                    raise error
+                if offset is not None and partition not in revoked:
+                    offsets[partition] = get_offset_metadata(offset)
+            if len(offsets) > 0:
+                try:
+                    consumer.commit(offsets)
+                    for partition, offset in offsets.items():
+                        table_consumers[partition.topic].committed({partition: offset})
+                except CommitFailedError as e:
+                    # the partitions were reassigned, the new owner consumes them from the last commit
+                    logging.error(f'{SHARED_CONSUMER}: commit failed: {e}')
+
+            # idle the process
+            if len(pending) < 1 and sum(in_flight.values()) < 1 and lag_tracker.is_consumed():
+                logging.info(f'{SHARED_CONSUMER} process idle')
+                wait_for_wake(stop_event, wake_event, idle)
+    finally:
+        if subscriber:
+            subscriber.stop()
+        workers_stop.set()
+        for thread in threads:
+            if thread.is_alive():
+                thread.join()
+        if consumer:
+            consumer.close()
+        for table_consumer in table_consumers.values():
+            table_consumer.close()
+
+    logging.info(f'{SHARED_CONSUMER} exited gracefully')
 
 
 def on_consumer_failure(consumer_task: Task, e, trace):
@@ -216,17 +1011,22 @@ def main():
 
     redis_config = config['redis']
 
-    # start the supported consumers
-    supported_consumers = get_supported_consumers()
+    # start the supported consumers, the shared consumers run in one task
+    shared_consumers = get_shared_consumers()
+    consumers = [(data_consumer, consumer, consumer) for consumer in get_supported_consumers() if
+                 consumer not in shared_consumers]
+    if len(shared_consumers) > 0:
+        consumers.append((shared_consumer, shared_consumers, SHARED_CONSUMER))
     max_read_fails_allowed = config['consumer']['max_read_fails_allowed']
     min_up_time = config['consumer']['min_up_time']
     consumer_tasks = []
-    for consumer in supported_consumers:
-        task = Task(func=data_consumer, args=(consumer,), kwargs={}, name=consumer,
+    for func, consumer, name in consumers:
+        task = Task(func=func, args=(consumer,), kwargs={}, name=name,
                     err_call_back=on_consumer_failure, term_call_back=on_consumer_terminate,
                     max_restarts=max_read_fails_allowed, min_up_time=min_up_time,
                     restart_delay=config['consumer']['restart_delay'],
-                    redis=get_redis_client(redis_config['host'], redis_config['port'], redis_config['db']))
+                    redis=get_redis_client(redis_config['host'], redis_config['port'], redis_config['db']),
+                    workers=config['consumer'].get('workers', 'thread'))
         task.start()
         consumer_tasks.append(task)
 
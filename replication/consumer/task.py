@@ -1,4 +1,6 @@
 import json
+import multiprocessing
+import signal as signals
 import threading
 import time
 import traceback
@@ -10,6 +12,7 @@ from typing import Optional
 from redis.client import PubSubWorkerThread
 
 from cache.connect import RedisHelper
+from logger.logger import set_process_log_name
 
 
 class Status(Enum):
@@ -46,17 +49,89 @@ class Thread(threading.Thread):
             self.redis.publish(f'{self.name}:manager', Status.ERROR.name)
 
 
+class TaskProcessError(Exception):
+    pass
+
+
+def get_process_context():
+    # spawned, a forked worker could inherit the locks held by the subscriber, monitor and log writer threads
+    return multiprocessing.get_context('spawn')
+
+
+def run_process_target(target: typing.Callable, name, args, kwargs, result):
+    # the task supervisor stops the worker by the stop signal, the worker logs to its own files
+    signals.signal(signals.SIGINT, signals.SIG_IGN)
+    signals.signal(signals.SIGTERM, signals.SIG_DFL)
+    set_process_log_name(name)
+    try:
+        target(*args, **kwargs)
+        result.send((Status.COMPLETE.name, None))
+    except Exception as e:
+        result.send((Status.ERROR.name, (repr(e), traceback.format_exc())))
+
+
+class Process:
+    """
+        runs the target in a worker process, the outcome is published to the task manager channel like Thread.
+        the stop signal (last argument) must be an event of the process context, the target and the arguments are
+        pickled to the spawned process
+    """
+
+    def __init__(self, target: typing.Callable, name, args, kwargs, redis, context=None):
+        self.context = context if context else get_process_context()
+        self.name = name
+        self.args = args
+        self.exc = None
+        self.trace = None
+        self.redis: RedisHelper = redis
+        self.result, result = self.context.Pipe(duplex=False)
+        self.process = self.context.Process(target=run_process_target, name=name,
+                                            args=(target, name, args, kwargs, result))
+        self.watcher = threading.Thread(target=self.watch, name=f'{name}-watcher', daemon=True)
+
+    def start(self):
+        self.process.start()
+        self.watcher.start()
+
+    def watch(self, poll_interval=1):
+        outcome = None
+        while outcome is None and (self.process.is_alive() or self.result.poll()):
+            if self.result.poll(poll_interval):
+                outcome = self.result.recv()
+        self.process.join()
+        if outcome is None:
+            outcome = (Status.ERROR.name, (f'worker process exited with code {self.process.exitcode}', ''))
+        status, error = outcome
+        if status == Status.COMPLETE.name:
+            signal = list(self.args)[-1]
+            if not signal.is_set():
+                self.redis.publish(f'{self.name}:manager', Status.COMPLETE.name)
+        else:
+            self.exc = TaskProcessError(error[0])
+            self.trace = error[1]
+            self.redis.publish(f'{self.name}:manager', Status.ERROR.name)
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def join(self, timeout=None):
+        self.process.join(timeout)
+        self.watcher.join(timeout)
+
+
 class Task:
 
     # FIXME too many arguments
     # noinspection PyRedundantParentheses
     def __init__(self, func, args, kwargs, name, err_call_back, term_call_back, max_restarts=3,
-                 min_up_time=60, restart_delay=10, redis=None):
+                 min_up_time=60, restart_delay=10, redis=None, workers='thread'):
         self.task = func
         self.args = args
         self.kwargs = kwargs
         self.name = name
-        self.signal = threading.Event()
+        # thread runs the task in this process, process in a worker process
+        self.workers = workers
+        self.signal = get_process_context().Event() if workers == 'process' else threading.Event()
         self.finish = threading.Event()
         self.terminate = threading.Event()
         self.max_restarts = max_restarts
@@ -65,7 +140,7 @@ class Task:
         self.err_call_back = err_call_back
         self.term_call_back = term_call_back
         self.redis: RedisHelper = redis
-        self.thread: Optional[Thread] = None
+        self.thread: Optional[typing.Union[Thread, Process]] = None
         self.subscriber: Optional[PubSubWorkerThread] = None
         self.last_failed = None
         self.failed_at = None
@@ -181,8 +256,9 @@ class Task:
     def start(self):
         if self.thread and self.thread.is_alive():
             return
-        self.thread = Thread(target=self.task, name=self.name, args=(*self.args, self.signal),
-                             kwargs=self.kwargs, redis=self.redis)
+        worker = Process if self.workers == 'process' else Thread
+        self.thread = worker(target=self.task, name=self.name, args=(*self.args, self.signal), kwargs=self.kwargs,
+                             redis=self.redis)
         self.thread.start()
         self.update_status(Status.ACTIVE)
 
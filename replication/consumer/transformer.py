@@ -1,4 +1,5 @@
 import json
+import traceback
 import typing
 from datetime import datetime
 from typing import Any, Callable, List, TypeVar
@@ -10,6 +11,11 @@ try:
 except ImportError:
     custom_transformers = {}
 
+try:
+    from tables.transform import custom_batch_transformers
+except ImportError:
+    custom_batch_transformers = {}
+
 T = TypeVar("T")
 
 
@@ -60,40 +66,173 @@ def get_type_cast_function(cast_str):
         return None
 
 
-def convert_to_ch_dict_using_schema(schema: typing.Dict, document):
-    result_document = {}
-    props = schema['properties']
-    for key in props:
-        ref_column = props[key]['ref'] if 'ref' in props[key] else key
-        if ref_column in document and document[ref_column] is not None:
-            value = document[ref_column]
-        elif key == schema['primary_key']:
-            raise ValueError(f'{key} primary key value is required')
-        elif 'required' not in props[key] or not props[key]['required']:
-            if 'default' in props[key]:
-                value = props[key]['default']
-            else:
-                result_document[key] = None
+def get_batch_cast_function(cast_str):
+    try:
+        return batch_cast_dict[cast_str]
+    except KeyError:
+        return None
+
+
+def get_value_caster(batch_caster):
+    def cast(value):
+        return batch_caster([value])[0]
+
+    return cast
+
+
+def get_multiple_type_caster(type_casters):
+    # handle optional/multiple types for the same field
+    def cast(value):
+        for type_cast in type_casters:
+            try:
+                return type_cast(value)
+            except (AssertionError, ValueError, TypeError):
                 continue
-        else:
-            raise ValueError(f'{key} value is not present')
-        type_caster = get_type_cast_function(props[key]['type'])
-        if not type_caster:
-            raise AttributeError(f"{props[key]['type']}: custom type cast mapping not found")
-        # handle optional/multiple types for the same field
-        if isinstance(type_caster, list):
-            for type_cast in type_caster:
-                try:
-                    value = type_cast(value)
-                    break
-                except (AssertionError, ValueError, TypeError):
+        raise ValueError
+
+    return cast
+
+
+def get_missing_type_caster(cast_str):
+    # raised only when the field has a value, like the missing mapping of an unused field is ignored
+    def cast(_):
+        raise AttributeError(f"{cast_str}: custom type cast mapping not found")
+
+    return cast
+
+
+def get_field_caster(cast_str):
+    type_caster = get_type_cast_function(cast_str)
+    if not type_caster and get_batch_cast_function(cast_str):
+        # a type registered only in the batch form is cast as a column of one value, the batch form runs on whole
+        # columns with clickhouse.columnar only
+        return get_value_caster(get_batch_cast_function(cast_str))
+    if not type_caster:
+        return get_missing_type_caster(cast_str)
+    if isinstance(type_caster, list):
+        return get_multiple_type_caster(type_caster)
+    return type_caster
+
+
+def get_field_fallback(key, prop, primary_key):
+    """ value of a missing field, None sets the field to None """
+    def raise_error(message):
+        def fallback():
+            raise ValueError(message)
+
+        return fallback
+
+    if key == primary_key:
+        return raise_error(f'{key} primary key value is required')
+    if 'required' not in prop or not prop['required']:
+        if 'default' in prop:
+            default = prop['default']
+            return lambda: default
+        return None
+    return raise_error(f'{key} value is not present')
+
+
+def get_schema_fields(schema: typing.Dict):
+    """ (column, ref column, missing value fallback, type caster) of every field of the schema """
+    return tuple((key, prop['ref'] if 'ref' in prop else key, get_field_fallback(key, prop, schema['primary_key']),
+                  get_field_caster(prop['type'])) for key, prop in schema['properties'].items())
+
+
+def compile_schema(schema: typing.Dict):
+    """
+        resolves the field names, type casters and defaults of the schema once, and returns the function that
+        converts a document to the clickhouse document
+    """
+    fields = get_schema_fields(schema)
+
+    def transform(document):
+        result_document = {}
+        for key, ref_column, fallback, type_caster in fields:
+            value = document.get(ref_column)
+            if value is None:
+                if fallback is None:
+                    result_document[key] = None
                     continue
-            else:
-                raise ValueError
-        else:
-            value = type_caster(value)
-        result_document[key] = value
-    return result_document
+                value = fallback()
+            result_document[key] = type_caster(value)
+        return result_document
+
+    return transform
+
+
+def cast_value(value, fallback, type_caster):
+    if value is None:
+        if fallback is None:
+            return None
+        value = fallback()
+    return type_caster(value)
+
+
+def cast_column_batch(values, fallback, batch_caster):
+    if fallback is not None:
+        values = [fallback() if value is None else value for value in values]
+    present = [index for index, value in enumerate(values) if value is not None]
+    if len(present) == len(values):
+        column = batch_caster(values)
+    else:
+        column = [None] * len(values)
+        for index, value in zip(present, batch_caster([values[index] for index in present])):
+            column[index] = value
+    if len(column) != len(values):
+        raise ValueError(f'batch transformer returned {len(column)} values for {len(values)}')
+    return column
+
+
+def cast_column(values, fallback, type_caster, errors, catch, batch_caster=None):
+    """
+        casts the values of a column, the batch caster is preferred when present. the errors of the failed rows are
+        kept by row index
+    """
+    if batch_caster:
+        try:
+            return cast_column_batch(values, fallback, batch_caster)
+        except catch:
+            pass
+    try:
+        return [cast_value(value, fallback, type_caster) for value in values]
+    except catch:
+        pass
+    # find the failed rows
+    column = []
+    for index, value in enumerate(values):
+        try:
+            column.append(cast_value(value, fallback, type_caster))
+        except catch:
+            if index not in errors:
+                errors[index] = traceback.format_exc()
+            column.append(None)
+    return column
+
+
+def compile_columnar_schema(schema: typing.Dict):
+    """
+        columnar form of compile_schema, the returned function converts a batch of documents to the values of every
+        column and the (document, error) of the documents that failed, exceptions other than catch are raised
+    """
+    fields = get_schema_fields(schema)
+    batch_casters = tuple(get_batch_cast_function(prop['type']) for prop in schema['properties'].values())
+
+    def transform(documents, catch=Exception):
+        columns = {}
+        errors = {}
+        for (key, ref_column, fallback, type_caster), batch_caster in zip(fields, batch_casters):
+            values = [document.get(ref_column) for document in documents]
+            columns[key] = cast_column(values, fallback, type_caster, errors, catch, batch_caster)
+        if len(errors) > 0:
+            columns = {key: [value for index, value in enumerate(column) if index not in errors] for key, column in
+                       columns.items()}
+        return columns, [(documents[index], error) for index, error in sorted(errors.items())]
+
+    return transform
+
+
+def convert_to_ch_dict_using_schema(schema: typing.Dict, document):
+    return compile_schema(schema)(document)
 
 
 cast_dict = {
@@ -106,3 +245,8 @@ cast_dict = {
     '[List, int]': from_list_of_int,
     **custom_transformers
 }
+
+# transformers of a whole column of values, preferred over cast_dict by the columnar transform
+batch_cast_dict = {
+    **custom_batch_transformers
+}
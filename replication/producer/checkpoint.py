@@ -0,0 +1,166 @@
+import os
+import threading
+from typing import Optional
+
+from redis.exceptions import RedisError
+
+from cache.connect import RedisHelper
+
+LAST_TICK = 'last-tick'
+PUBLISH_LAG = 'producer:lag'
+
+
+def read_journal_tick(path) -> Optional[int]:
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as journal:
+        lines = journal.read().split(b'\n')
+    # the last line may be partially written
+    for line in reversed(lines):
+        try:
+            return int(line)
+        except ValueError:
+            continue
+    return None
+
+
+def reset_journal(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class TickCheckpoint:
+    """
+        stores the last processed tick in redis and in an append-only local journal, commits are coalesced and
+        written from a background thread every interval seconds or once max_pending commits are waiting.
+        interval 0 writes every commit synchronously. the publish lag of the last chunk is written to the
+        producer:lag redis hash by the background thread only
+    """
+
+    def __init__(self, redis_helper: RedisHelper, journal_path, interval=0, max_pending=100, fsync=True,
+                 max_journal_size=1048576, logging=None):
+        self.redis: RedisHelper = redis_helper
+        self.journal_path = journal_path
+        self.interval = interval
+        self.max_pending = max_pending
+        self.fsync = fsync
+        self.max_journal_size = max_journal_size
+        self.logging = logging
+        self.tick = None
+        self.stored_tick = None
+        self.pending = 0
+        self.publish_lag = None
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.journal = None
+        self.thread: Optional[threading.Thread] = None
+
+    def recover(self):
+        """ picks the newer tick of redis and the journal, and brings both copies to that tick """
+        redis_tick = self.redis.client.get(LAST_TICK)
+        redis_tick = int(redis_tick) if redis_tick else None
+        journal_tick = read_journal_tick(self.journal_path)
+        ticks = [tick for tick in (redis_tick, journal_tick) if tick is not None]
+        self.tick = max(ticks) if len(ticks) > 0 else None
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'ab')
+        if self.tick is not None and self.tick != redis_tick:
+            self.redis.client.set(LAST_TICK, self.tick)
+        if self.tick is not None and self.tick != journal_tick:
+            self.append(self.tick)
+        self.stored_tick = self.tick
+        return self.tick
+
+    def start(self):
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self.run, name='tick-checkpoint', daemon=True)
+            self.thread.start()
+        return self
+
+    def commit(self, tick):
+        with self.condition:
+            self.tick = int(tick)
+            self.pending += 1
+            if self.pending >= self.max_pending:
+                self.condition.notify()
+        if self.interval > 0:
+            return True
+        return self.write()
+
+    def set_publish_lag(self, publish_lag, tick):
+        with self.condition:
+            self.publish_lag = (publish_lag, tick)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with self.condition:
+                if self.pending < self.max_pending:
+                    self.condition.wait(timeout=self.interval)
+            # noinspection PyBroadException
+            try:
+                self.write()
+            except Exception as e:
+                # the tick is kept and written again on the next interval
+                if self.logging:
+                    self.logging.error(f'unable to store tick {self.tick}: {e}')
+            self.write_publish_lag()
+
+    def write_publish_lag(self):
+        with self.condition:
+            publish_lag, self.publish_lag = self.publish_lag, None
+        if publish_lag is None:
+            return False
+        try:
+            self.redis.client.hset(PUBLISH_LAG, mapping={'publish_lag': round(publish_lag[0], 3),
+                                                         'tick': publish_lag[1]})
+            return True
+        except RedisError as e:
+            # a metric only, the next lag is written on the next interval
+            if self.logging:
+                self.logging.error(f'unable to store the publish lag: {e}')
+            return False
+
+    def write(self):
+        with self.write_lock:
+            with self.condition:
+                tick, self.pending = self.tick, 0
+            if tick is None or tick == self.stored_tick:
+                return True
+            self.append(tick)
+            if not self.redis.client.set(LAST_TICK, tick):
+                return False
+            self.stored_tick = tick
+            return True
+
+    def append(self, tick):
+        self.journal.write(f'{tick}\n'.encode())
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+        if self.journal.tell() > self.max_journal_size:
+            self.compact(tick)
+
+    def compact(self, tick):
+        compact_path = f'{self.journal_path}.compact'
+        with open(compact_path, 'wb') as journal:
+            journal.write(f'{tick}\n'.encode())
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.journal.close()
+        os.replace(compact_path, self.journal_path)
+        self.journal = open(self.journal_path, 'ab')
+
+    def flush(self):
+        return self.write()
+
+    def close(self):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.write_publish_lag()
+        self.flush()
+        if self.journal:
+            self.journal.close()
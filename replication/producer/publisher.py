@@ -1,14 +1,25 @@
 import os
 import pathlib
 import threading
+import time
 import traceback
 
+import orjson
+from redis.exceptions import RedisError
+
 from arangodb.connect import get_singleton_arango_client
 from arangodb.wal import ArangoWAL
 from cache.connect import RedisHelper, get_singleton_redis_client
-from replication.producer.reader import get_logs, get_wal_client, LogOpTypes, json_encode, key_encode, LogGenerator
-from replication.producer.writer import get_log_writer
-from util.basic_utils import LOGGER, CONFIG, SMTP_CLIENT, prepare_logger
+from replication.producer.checkpoint import TickCheckpoint
+from replication.producer.reader import get_logs, get_wal_client, LogOpTypes, json_encode, key_encode, LogGenerator, \
+    LogPrefetcher, scan_logs, ChunkSizer, tick_to_timestamp
+from replication.producer.spool import LogSpool
+from replication.producer.tick_index import TickIndex
+from replication.producer.transaction import TransactionBuffer, is_transaction_marker
+from replication.producer.writer import get_log_writer, AckTracker
+from replication.schema.helper import get_table_map_by_arango_collection, get_referenced_attributes
+from util.basic_utils import LOGGER, CONFIG, SMTP_CLIENT, prepare_logger, \
+    is_logger_asynchronous
 from util.basic_utils import get_basic_utilities
 from util.terminate import Terminate
 
@@ -17,7 +28,7 @@ def get_logger():
     config, logging = get_basic_utilities().get_utils((CONFIG, LOGGER))
     if 'logs_path' in config['logs']:
         logs_path = str(pathlib.Path(config['logs']['logs_path']).joinpath('producer'))
-        return prepare_logger(logs_path, os.getenv('env'))
+        return prepare_logger(logs_path, os.getenv('env'), is_logger_asynchronous(config))
     return logging
 
 
@@ -40,12 +51,6 @@ def updated_last_processed_tick(redis_helper: RedisHelper, tick):
     return redis_helper.client.set("last-tick", tick)
 
 
-def update_file_last_tick(file, tick):
-    file.seek(0)
-    file.write(f'{tick};')
-    file.flush()
-
-
 def get_arango_collections(arango_config):
     arango_db_client = get_singleton_arango_client(arango_config)
     return arango_db_client.db.collections
@@ -59,12 +64,17 @@ def is_document_allowed(document, collections_ids):
 
 
 # result batch size may be vary due to arango log chunk_size and log filtering
-def collect_logs(arango_wal_client, tick_min, batch_size, collections):
+# passthrough keeps the raw wal entries of the allowed documents instead of deserializing them
+# transactions keeps the transaction markers along with the allowed documents
+def collect_logs(arango_wal_client, tick_min, batch_size, collections, passthrough=False, chunk_sizer=None,
+                 transactions=False):
     collections_id_set = set(collections.values())
-    log_generator = LogGenerator(get_logs(arango_wal_client, tick_min, batch_size))
+    log_generator = LogGenerator(get_logs(arango_wal_client, tick_min, batch_size, deserialize=not passthrough,
+                                          chunk_sizer=chunk_sizer))
     for documents in log_generator:
-        documents['content'] = [document for document in documents['content'] if
-                                is_document_allowed(document, collections_id_set)]
+        content = scan_logs(documents['content']) if passthrough else documents['content']
+        documents['content'] = [document for document in content if is_document_allowed(document, collections_id_set)
+                                or (transactions and is_transaction_marker(document))]
         is_processed = yield documents
         log_generator.is_processed(is_processed)
 
@@ -77,19 +87,146 @@ def get_topic_name(document, collection_id_dict):
     return collection_id_dict[document['cuid']]
 
 
+def get_document_key(document):
+    if 'raw' in document:
+        return document['key']
+    try:
+        return document['data']['_key']
+    except KeyError:
+        return None
+
+
 def prepare_kafka_documents(collections_id_dict, docs, writer_timeout):
     kafka_documents = []
     for doc in docs['content']:
-        kafka_document = {'topic': get_topic_name(doc, collections_id_dict), 'value': doc,
-                          'timeout': writer_timeout}
-        try:
-            kafka_document['key'] = doc['data']['_key']
-        except KeyError:
-            kafka_document['key'] = None
-        kafka_documents.append(kafka_document)
+        kafka_documents.append({'topic': get_topic_name(doc, collections_id_dict),
+                                'value': doc['raw'] if 'raw' in doc else doc, 'key': get_document_key(doc),
+                                'timeout': writer_timeout, 'tick': doc['tick']})
     return kafka_documents
 
 
+def get_tick_checkpoint(producer_config, redis_helper: RedisHelper, logging):
+    return TickCheckpoint(redis_helper, producer_config.get('checkpoint_journal', 'last-tick.journal'),
+                          interval=producer_config.get('checkpoint_interval', 0),
+                          max_pending=producer_config.get('checkpoint_max_pending', 100),
+                          fsync=producer_config.get('checkpoint_fsync', True), logging=logging)
+
+
+def get_tick_index(producer_config, redis_helper: RedisHelper):
+    if not producer_config.get('tick_index', False):
+        return None
+    return TickIndex(redis_helper, producer_config.get('tick_index_interval', 60),
+                     producer_config.get('tick_index_max_entries', 10000))
+
+
+def store_tick_index(tick_index: TickIndex, logging):
+    try:
+        return tick_index.store()
+    except RedisError as e:
+        # the samples are dropped, the next samples are stored on the next chunk
+        logging.error(f'unable to store the tick index: {e}')
+        return 0
+
+
+def get_spool(producer_config, log_writer, logging, on_forward=None):
+    if not producer_config.get('spool', False):
+        return None
+    return LogSpool(producer_config.get('spool_path', 'spool'), log_writer, json_encode,
+                    segment_size=producer_config.get('spool_segment_size', 67108864),
+                    max_size=producer_config.get('spool_max_size', 1073741824),
+                    fsync=producer_config.get('spool_fsync', True), logging=logging,
+                    on_forward=on_forward).open().start()
+
+
+def notify_topics(redis_helper: RedisHelper, topics):
+    """ wakes the idle consumers of the topics published to kafka, the consumers poll on their idle time otherwise """
+    try:
+        for topic in topics:
+            redis_helper.publish(f'{topic}:wal', 1)
+        return True
+    except RedisError:
+        return False
+
+
+def get_transaction_buffer(producer_config):
+    if not producer_config.get('transactions', False):
+        return None
+    return TransactionBuffer(producer_config.get('transaction_memory', 67108864),
+                             producer_config.get('transaction_spill_dir'))
+
+
+def get_chunk_sizer(producer_config):
+    if not producer_config.get('reader_adaptive', False):
+        return None
+    reader_batch = producer_config['reader_batch']
+    return ChunkSizer(reader_batch, producer_config.get('reader_batch_min', reader_batch),
+                      producer_config.get('reader_batch_max', reader_batch * 64),
+                      producer_config.get('reader_target_latency', 1.0))
+
+
+class IdleBackoff:
+    """
+        idle time between the wal polls, starts at min_idle after any wal activity and grows by the factor
+        up to max_idle while the wal stays quiet
+    """
+
+    def __init__(self, min_idle, max_idle, factor=2):
+        self.min_idle = min(min_idle, max_idle)
+        self.max_idle = max_idle
+        self.factor = factor
+        self.idle = self.min_idle
+
+    def reset(self):
+        self.idle = self.min_idle
+
+    def next(self):
+        idle = self.idle
+        self.idle = min(self.idle * self.factor, self.max_idle)
+        return idle
+
+
+def get_publish_lag(docs):
+    if len(docs['content']) < 1:
+        return None
+    return max(time.time() - tick_to_timestamp(docs['content'][-1]['tick']), 0)
+
+
+def get_projections(collections_id_dict):
+    """ referenced attributes of the synced collections by collection id, collections without table map are skipped """
+    projections = {}
+    for collection, collection_id in collections_id_dict.items():
+        table_map = get_table_map_by_arango_collection(collection)
+        if table_map is not None:
+            projections[collection_id] = get_referenced_attributes(table_map)
+    return projections
+
+
+def project_document(document, attributes):
+    if 'raw' in document:
+        value = orjson.loads(document['raw'])
+        value['data'] = {attribute: value['data'][attribute] for attribute in attributes if attribute in value['data']}
+        document['raw'] = orjson.dumps(value)
+    elif 'data' in document:
+        data = document['data']
+        document['data'] = {attribute: data[attribute] for attribute in attributes if attribute in data}
+    return document
+
+
+def project_documents(documents, projections):
+    return [project_document(document, projections[document['cuid']]) if document['cuid'] in projections else
+            document for document in documents]
+
+
+def coalesce_kafka_documents(kafka_documents):
+    """ keeps only the latest message of every document key of a topic, messages without a key are kept """
+    latest = {}
+    for index, kafka_document in enumerate(kafka_documents):
+        if kafka_document['key'] is not None:
+            latest[(kafka_document['topic'], kafka_document['key'])] = index
+    return [kafka_document for index, kafka_document in enumerate(kafka_documents) if
+            kafka_document['key'] is None or latest[(kafka_document['topic'], kafka_document['key'])] == index]
+
+
 def on_producer_exit():
     logging = get_logger()
     logging.info('producer terminating gracefully')
@@ -104,8 +241,6 @@ def producer():
     arango_wal_client = get_wal_client({**config['arango'], **config['wal']})
     redis_helper = get_singleton_redis_client(config['redis']['host'], config['redis']['port'], config['redis']['db'])
 
-    last_tick_file = open('last-tick.txt', 'w')
-
     arango_collections = get_arango_collections(config['arango'])
     collections_id_dict = {collection: meta.globallyUniqueId for collection, meta in arango_collections.items() if
                            collection in producer_config['sync']}
@@ -113,54 +248,183 @@ def producer():
 
     logging.info(f'listening collections: {list(collections_id_dict.keys())}')
 
+    # restore the newer tick of redis and the local journal before falling back to the current wal tick
+    checkpoint = get_tick_checkpoint(producer_config, redis_helper, logging)
+    recovered_tick = checkpoint.recover()
+    if recovered_tick:
+        logging.info(f'recovered tick: {recovered_tick}')
+
     # set last-tick as first tick during only the first start
     init_tick = set_tick_if_not_set(arango_wal_client, redis_helper)
     if init_tick:
         logging.info(f'stored initial tick: {init_tick}')
+        checkpoint.recover()
+    checkpoint.start()
 
-    _ = config['producer']['reader_batch']
+    reader_batch = config['producer']['reader_batch']
+    chunk_sizer = get_chunk_sizer(producer_config)
     writer_timeout = config['producer']['writer_timeout']
+    prefetch = producer_config.get('prefetch', 0)
+    passthrough = producer_config.get('passthrough', False)
+    max_in_flight = producer_config.get('max_in_flight', 0)
+    transaction_buffer = get_transaction_buffer(producer_config)
+    coalesce = producer_config.get('coalesce', False)
+    projections = get_projections(collections_id_dict) if producer_config.get('projection', False) else None
 
     log_writer = get_log_writer(config['kafka']['host'], config['kafka']['port'], key_encode, json_encode)()
+    # notify the consumers once kafka accepted the messages of their topics
+    notify = producer_config.get('notify', False)
+    notify_pending = set()
 
-    exit_event = threading.Event()
-    _ = Terminate(exit_event)
-
-    while not exit_event.is_set():
-        last_tick = get_last_processed_tick(redis_helper)
-        logging.info(f'last processed tick: {last_tick}')
-
-        logs_collector = collect_logs(arango_wal_client, last_tick, None, collections_id_dict)
-        logs_generator = LogGenerator(logs_collector)
-
-        for docs in logs_generator:
+    # the spooled chunks are stored before kafka accepts them, the acknowledgement tracking is not needed
+    spool = get_spool(producer_config, log_writer, logging,
+                      on_forward=(lambda topics: notify_topics(redis_helper, topics)) if notify else None)
+    if spool:
+        max_in_flight = 0
+    # the spooled messages are forwarded by the drainer, the tick index samples the directly published ones
+    tick_index = get_tick_index(producer_config, redis_helper) if not spool else None
 
-            tick_start = docs['content'][0]['tick'] if len(docs['content']) > 0 else None
+    idle_backoff = IdleBackoff(producer_config.get('min_idle', producer_config['idle']), producer_config['idle'])
+    last_tick, resume_tick = None, None
 
-            if not docs['from_present']:
-                logging.error(f'ticks lost asked for {last_tick} but got {tick_start}')
-
-            # store in kafka
-            log_writer.bulk_write(prepare_kafka_documents(id_to_collection_dict, docs, writer_timeout))
-            log_writer.flush()
-
-            # update tick only if valid
-            if int(docs['last_included']) > 0:
-                if updated_last_processed_tick(redis_helper, docs['last_included']):
-                    update_file_last_tick(last_tick_file, docs['last_included'])
-                    # if is_processed set to False then the data batch will be processed again
-                    # setting False always will lead to infinite loop
-                    logs_generator.is_processed(True)
-
-            logging.info(f'processed {f"{tick_start}-" if tick_start else ""}{docs["last_included"]}: '
-                         f'overall {len(docs["content"])} docs')
-
-            # handle termination call
-            if exit_event.is_set():
-                break
+    exit_event = threading.Event()
+    _ = Terminate(exit_event)
 
-        logging.info('sleeping')
-        exit_event.wait(timeout=config['producer']['idle'])
+    try:
+        while not exit_event.is_set():
+            # the stored tick may stay behind the tail position while transactions are open
+            previous_tick, last_tick = last_tick, resume_tick if resume_tick else checkpoint.tick
+            if last_tick != previous_tick:
+                logging.info(f'last processed tick: {last_tick}')
+            ack_tracker = AckTracker() if max_in_flight else None
+            stored_tick = last_tick
+
+            # the server default chunk size is used unless the chunks are sized adaptively
+            logs_collector = collect_logs(arango_wal_client, last_tick, reader_batch if chunk_sizer else None,
+                                          collections_id_dict, passthrough, chunk_sizer, transaction_buffer is not None)
+            logs_generator = LogGenerator(logs_collector)
+            if prefetch:
+                logs_generator = LogPrefetcher(logs_generator, prefetch, exit_event).start()
+
+            try:
+                for docs in logs_generator:
+                    idle_backoff.reset()
+
+                    tick_start = docs['content'][0]['tick'] if len(docs['content']) > 0 else None
+
+                    if not docs['from_present']:
+                        logging.error(f'ticks lost asked for {last_tick} but got {tick_start}')
+
+                    # publish only the committed operations, the tick is held before the open transactions
+                    commit_tick = docs['last_included']
+                    if transaction_buffer:
+                        docs['content'] = transaction_buffer.add(docs['content'])
+                        commit_tick = transaction_buffer.safe_tick(docs['last_included'])
+
+                    # publish only the attributes read by the table schemas
+                    if projections:
+                        docs['content'] = project_documents(docs['content'], projections)
+
+                    # store in kafka
+                    publish_started = time.monotonic()
+                    kafka_documents = prepare_kafka_documents(id_to_collection_dict, docs, writer_timeout)
+                    if coalesce:
+                        documents_count = len(kafka_documents)
+                        kafka_documents = coalesce_kafka_documents(kafka_documents)
+                        if documents_count > len(kafka_documents):
+                            logging.info(f'coalesced {documents_count - len(kafka_documents)} docs')
+                    if spool:
+                        # the drainer forwards the spooled chunks to kafka, waits while the spool is full
+                        if not spool.append(kafka_documents, exit_event):
+                            logs_generator.is_processed(False)
+                            break
+                    elif ack_tracker:
+                        responses = log_writer.bulk_write(kafka_documents)
+                        if tick_index:
+                            tick_index.track(kafka_documents, [response['meta'] for response in responses])
+                        # keep chunks in flight and store the tick acknowledged by kafka
+                        ack_tracker.track(commit_tick, [response['meta'] for response in responses])
+                        acked_tick = ack_tracker.wait(max_in_flight, exit_event)
+                        if acked_tick and acked_tick != stored_tick and checkpoint.commit(acked_tick):
+                            stored_tick = acked_tick
+                        logs_generator.is_processed(True)
+                        if notify:
+                            notify_pending.update(document['topic'] for document in kafka_documents)
+                            if ack_tracker.in_flight() < 1:
+                                notify_topics(redis_helper, notify_pending)
+                                notify_pending.clear()
+                    else:
+                        responses = log_writer.bulk_write(kafka_documents)
+                        if tick_index:
+                            tick_index.track(kafka_documents, [response['meta'] for response in responses])
+                        log_writer.flush()
+                        if notify:
+                            notify_topics(redis_helper, {document['topic'] for document in kafka_documents})
+
+                    if tick_index:
+                        store_tick_index(tick_index, logging)
+
+                    if chunk_sizer:
+                        chunk_size = chunk_sizer.update(docs, time.monotonic() - publish_started)
+                        if chunk_size != docs['chunk_size']:
+                            logging.info(f'wal chunk size changed: {docs["chunk_size"]} -> {chunk_size} bytes')
+
+                    # update tick only if valid
+                    if not ack_tracker and int(docs['last_included']) > 0:
+                        if checkpoint.commit(commit_tick):
+                            # if is_processed set to False then the data batch will be processed again
+                            # setting False always will lead to infinite loop
+                            logs_generator.is_processed(True)
+                        elif prefetch:
+                            # prefetched chunks are ahead of the stored tick, tail again from the stored tick
+                            logging.error(f'unable to store tick {docs["last_included"]}, '
+                                          f'resuming from the stored tick')
+                            logs_generator.is_processed(False)
+                            resume_tick = None
+                            if transaction_buffer:
+                                transaction_buffer.clear()
+                            break
+                    resume_tick = docs['last_included']
+
+                    publish_lag = get_publish_lag(docs)
+                    if publish_lag is not None:
+                        checkpoint.set_publish_lag(publish_lag, docs['last_included'])
+                    chunk_info = f', chunk size: {docs["chunk_size"]} bytes' if chunk_sizer else ''
+                    logging.info(f'processed {f"{tick_start}-" if tick_start else ""}{docs["last_included"]}: '
+                                 f'overall {len(docs["content"])} docs{chunk_info}'
+                                 f'{f", publish lag: {publish_lag:.3f}s" if publish_lag is not None else ""}')
+                    if transaction_buffer and len(transaction_buffer.transactions) > 0:
+                        logging.info(f'open transactions: {len(transaction_buffer.transactions)}, '
+                                     f'buffered {transaction_buffer.pending()} docs')
+                    if spool:
+                        spool_segments, spool_size = spool.depth()
+                        logging.info(f'spool depth: {spool_segments} segments, {spool_size} bytes')
+
+                    # handle termination call
+                    if exit_event.is_set():
+                        break
+            finally:
+                if prefetch:
+                    logs_generator.close()
+
+            # wait for the messages in flight before idling
+            if ack_tracker:
+                log_writer.flush()
+                acked_tick = ack_tracker.wait(0, exit_event)
+                if acked_tick and acked_tick != stored_tick and checkpoint.commit(acked_tick):
+                    logging.info(f'acknowledged tick: {acked_tick}')
+                if notify and len(notify_pending) > 0:
+                    notify_topics(redis_helper, notify_pending)
+                    notify_pending.clear()
+
+            idle = idle_backoff.next()
+            if idle >= idle_backoff.max_idle:
+                logging.info('sleeping')
+            exit_event.wait(timeout=idle)
+    finally:
+        if spool:
+            spool.close()
+        checkpoint.close()
 
     logging.info('producer terminated gracefully')
 
@@ -1,3 +1,9 @@
+import json
+import queue
+import re
+import threading
+import time
+
 import orjson
 # noinspection PyPackageRequirements
 from arango.wal import WAL
@@ -6,6 +12,13 @@ from arangodb.connect import ArangoDbConfig
 from arangodb.wal import get_singleton_wal_client
 
 
+LOG_TICK = re.compile(r'"tick":"(\d+)"')
+LOG_TYPE = re.compile(r'"type":(\d+)')
+LOG_CUID = re.compile(r'"cuid":"([^"]*)"')
+LOG_TID = re.compile(r'"tid":"(\d+)"')
+LOG_KEY = re.compile(r'\{"_key":"([^"]*)"')
+
+
 class LogOpTypes:
     START_TRANSACTION = 2200
     COMMIT_TRANSACTION = 2201
@@ -14,6 +27,11 @@ class LogOpTypes:
     REMOVE_DOCUMENT = 2302
 
 
+def tick_to_timestamp(tick):
+    # arango ticks are hybrid logical clock values, the upper bits hold the physical time in milliseconds
+    return (int(tick) >> 20) / 1000
+
+
 def get_wal_client(config: dict):
     return get_singleton_wal_client(ArangoDbConfig(
         host=config['host'],
@@ -25,6 +43,9 @@ def get_wal_client(config: dict):
 
 
 def json_encode(obj):
+    # raw wal entries are forwarded as they are
+    if isinstance(obj, bytes):
+        return obj
     return orjson.dumps(obj)
 
 
@@ -59,12 +80,167 @@ class LogGenerator:
         self.prev_processed = value
 
 
-def get_logs(client, tick_start, chunk_size=16384):
+def parse_log(line: str):
+    document = orjson.loads(line)
+    return {'tick': document.get('tick'), 'type': document.get('type'), 'cuid': document.get('cuid'),
+            'tid': document.get('tid'), 'key': document['data'].get('_key') if 'data' in document else None,
+            'raw': line.encode()}
+
+
+def scan_log(line: str):
+    """
+        extracts tick, type, cuid, tid and data._key of a raw wal entry without deserializing the document,
+        the original entry is kept as bytes in raw. falls back to the json parser if the entry does not
+        follow the arango serialization order (header attributes first, _key as the first document attribute)
+    """
+    data_at = line.find('"data":')
+    header = line if data_at < 0 else line[:data_at]
+    tick, log_type = LOG_TICK.search(header), LOG_TYPE.search(header)
+    if tick is None or log_type is None:
+        return parse_log(line)
+    cuid, tid, key = LOG_CUID.search(header), LOG_TID.search(header), None
+    if data_at >= 0:
+        key = LOG_KEY.match(line, data_at + 7)
+        if key is None or cuid is None:
+            return parse_log(line)
+        key = key.group(1)
+    return {'tick': tick.group(1), 'type': int(log_type.group(1)), 'cuid': cuid.group(1) if cuid else None,
+            'tid': tid.group(1) if tid else None, 'key': key, 'raw': line.encode()}
+
+
+def scan_logs(content: str):
+    return [scan_log(line) for line in content.split('\n') if line]
+
+
+class ChunkSizer:
+    """
+        picks the wal chunk size (bytes) of the next tail call, the size is scaled towards the target latency
+        using the measured fetch time per byte, publish time per entry and bytes per entry of the full chunks
+    """
+
+    def __init__(self, initial, min_size, max_size, target_latency=1.0, smoothing=.3, max_step=2):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.max_step = max_step
+        self.chunk_size = self.clamp(initial)
+        self.fetch_per_byte = None
+        self.publish_per_entry = None
+        self.bytes_per_entry = None
+
+    def clamp(self, size):
+        return int(min(max(size, self.min_size), self.max_size))
+
+    def average(self, current, value):
+        return value if current is None else current + self.smoothing * (value - current)
+
+    def update(self, documents_info, publish_time):
+        size, entries = documents_info['size'], documents_info['entries']
+        # only the chunks limited by the chunk size tell how large the next one can be
+        if not documents_info['check_more'] or size == 0 or entries == 0:
+            return self.chunk_size
+        self.fetch_per_byte = self.average(self.fetch_per_byte, documents_info['fetch_time'] / size)
+        self.publish_per_entry = self.average(self.publish_per_entry, publish_time / entries)
+        self.bytes_per_entry = self.average(self.bytes_per_entry, size / entries)
+        cost_per_byte = self.fetch_per_byte + self.publish_per_entry / self.bytes_per_entry
+        if cost_per_byte <= 0:
+            return self.chunk_size
+        desired = self.target_latency / cost_per_byte
+        desired = min(max(desired, self.chunk_size / self.max_step), self.chunk_size * self.max_step)
+        self.chunk_size = self.clamp(desired)
+        return self.chunk_size
+
+
+def get_logs(client, tick_start, chunk_size=None, deserialize=True, chunk_sizer: ChunkSizer = None):
     wal: WAL = client.wal
     load = True
     while load:
-        documents_info = wal.tail(lower=tick_start, deserialize=True, server_id=888, chunk_size=chunk_size)
+        if chunk_sizer:
+            chunk_size = chunk_sizer.chunk_size
+        started = time.monotonic()
+        documents_info = wal.tail(lower=tick_start, deserialize=False, server_id=888, chunk_size=chunk_size)
+        content = documents_info['content']
+        documents_info['fetch_time'] = time.monotonic() - started
+        documents_info['chunk_size'] = chunk_size
+        # the chunk statistics are used only by the chunk sizer
+        if chunk_sizer:
+            documents_info['size'] = len(content)
+            documents_info['entries'] = content.count('\n')
+        if deserialize:
+            documents_info['content'] = [json.loads(line) for line in content.split('\n') if line]
         is_processed = yield documents_info
         if is_processed:
             load = documents_info['check_more']
             tick_start = documents_info['last_included']
+
+
+class LogPrefetcher:
+    """
+        tails the wal ahead of the publisher, chunks are fetched on a background thread into a bounded queue
+        and handed over in the same order they were tailed
+    """
+
+    _END = object()
+
+    def __init__(self, log_generator: LogGenerator, depth, exit_event: threading.Event, poll_interval=.1):
+        self.log_generator = log_generator
+        self.chunks = queue.Queue(maxsize=max(depth, 1))
+        self.exit_event = exit_event
+        self.stop_event = threading.Event()
+        self.poll_interval = poll_interval
+        self.thread = threading.Thread(target=self.fetch, name='wal-prefetch', daemon=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                data = self.chunks.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if self.is_stopped():
+                    raise StopIteration
+                continue
+            if data is LogPrefetcher._END:
+                raise StopIteration
+            if isinstance(data, Exception):
+                raise data
+            return data
+
+    def is_stopped(self):
+        return self.stop_event.is_set() or self.exit_event.is_set()
+
+    def put(self, data):
+        while not self.is_stopped():
+            try:
+                self.chunks.put(data, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch(self):
+        # noinspection PyBroadException
+        try:
+            for documents in self.log_generator:
+                if not self.put(documents):
+                    return
+                # the fetch stage never waits for the publisher, failed chunks are re-tailed from the stored tick
+                self.log_generator.is_processed(True)
+            self.put(LogPrefetcher._END)
+        except Exception as e:
+            self.put(e)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def is_processed(self, value):
+        # a chunk can not be replayed once the fetch stage moved ahead, stop tailing and let the caller resume
+        if not value:
+            self.stop_event.set()
+
+    def close(self, timeout=10):
+        self.stop_event.set()
+        self.thread.join(timeout=timeout)
@@ -0,0 +1,219 @@
+import os
+import threading
+from typing import Optional
+
+import msgpack
+
+from replication.producer.writer import LogWriter
+
+SEGMENT_SUFFIX = '.segment'
+
+
+def get_segment_name(sequence):
+    return f'{sequence:020d}{SEGMENT_SUFFIX}'
+
+
+class LogSpool:
+    """
+        durable local spool between the wal reader and kafka. published batches are appended to segmented
+        append-only files, so the tick can be stored before kafka accepts the messages, and a background drainer
+        forwards the segments to kafka in order. appends wait while the spool is larger than max_size
+    """
+
+    def __init__(self, path, log_writer: LogWriter, value_serializer, segment_size=67108864, max_size=1073741824,
+                 fsync=True, read_size=4194304, drain_batch=10000, retry_delay=5, logging=None, on_forward=None):
+        self.path = path
+        self.log_writer = log_writer
+        self.value_serializer = value_serializer
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync = fsync
+        self.read_size = read_size
+        self.drain_batch = drain_batch
+        self.retry_delay = retry_delay
+        self.logging = logging
+        # called with the topics of every forwarded batch
+        self.on_forward = on_forward
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.segment = None
+        self.segment_sequence = None
+        self.cursor = (0, 0)
+        self.thread: Optional[threading.Thread] = None
+
+    def segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path) if
+                      name.endswith(SEGMENT_SUFFIX))
+
+    def segment_path(self, sequence):
+        return os.path.join(self.path, get_segment_name(sequence))
+
+    def read_cursor(self):
+        cursor_path = os.path.join(self.path, 'cursor')
+        if not os.path.exists(cursor_path):
+            return 0, 0
+        with open(cursor_path, 'r') as cursor:
+            sequence, offset = cursor.read().split()
+        return int(sequence), int(offset)
+
+    def write_cursor(self, sequence, offset):
+        cursor_path = os.path.join(self.path, 'cursor')
+        with open(f'{cursor_path}.tmp', 'w') as cursor:
+            cursor.write(f'{sequence} {offset}')
+            cursor.flush()
+            os.fsync(cursor.fileno())
+        os.replace(f'{cursor_path}.tmp', cursor_path)
+        with self.condition:
+            self.cursor = (sequence, offset)
+            self.condition.notify_all()
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        segments = self.segments()
+        self.cursor = self.read_cursor()
+        if len(segments) > 0 and self.cursor[0] < segments[0]:
+            self.cursor = (segments[0], 0)
+        # a new segment on every start, the last segment may end with a partially written record
+        self.open_segment(segments[-1] + 1 if len(segments) > 0 else self.cursor[0])
+        return self
+
+    def open_segment(self, sequence):
+        if self.segment:
+            self.segment.close()
+        self.segment_sequence = sequence
+        self.segment = open(self.segment_path(sequence), 'ab')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.drain, name='spool-drainer', daemon=True)
+        self.thread.start()
+        return self
+
+    def depth(self):
+        """ number of segments and bytes not forwarded to kafka yet """
+        with self.condition:
+            sequence, offset = self.cursor
+        segments, size = 0, 0
+        for segment in self.segments():
+            if segment < sequence:
+                continue
+            try:
+                size += os.path.getsize(self.segment_path(segment))
+                segments += 1
+            except FileNotFoundError:
+                # drained meanwhile
+                continue
+        return segments, max(size - offset, 0)
+
+    def append(self, kafka_documents, exit_event: threading.Event, poll_interval=.1):
+        while self.depth()[1] > self.max_size:
+            if exit_event.is_set():
+                return False
+            with self.condition:
+                self.condition.wait(timeout=poll_interval)
+        records = b''.join(msgpack.packb([document['topic'], document['key'],
+                                          self.value_serializer(document['value'])]) for document in kafka_documents)
+        with self.condition:
+            self.segment.write(records)
+            self.segment.flush()
+            if self.fsync:
+                os.fsync(self.segment.fileno())
+            if self.segment.tell() > self.segment_size:
+                self.open_segment(self.segment_sequence + 1)
+            self.condition.notify_all()
+        return True
+
+    def read(self, sequence, offset):
+        """
+            complete records of the segment from the offset, with the offset after every record, and the number of
+            the read bytes after the last record. the segment is read in read_size blocks until a record is complete
+            or the end of the segment, so a record larger than read_size is read whole
+        """
+        # no limit of the buffer, the size of a record is limited by the kafka messages
+        unpacker = msgpack.Unpacker(raw=False, max_buffer_size=0)
+        records, size = [], 0
+        with open(self.segment_path(sequence), 'rb') as segment:
+            segment.seek(offset)
+            while len(records) < 1:
+                data = segment.read(self.read_size)
+                if len(data) < 1:
+                    break
+                size += len(data)
+                unpacker.feed(data)
+                for record in unpacker:
+                    records.append((record, offset + unpacker.tell()))
+                    if len(records) >= self.drain_batch:
+                        break
+        return records, size - (records[-1][1] - offset if len(records) > 0 else 0)
+
+    def forward(self, records):
+        futures = [self.log_writer.write(topic, value, key=key) for (topic, key, value), _ in records]
+        self.log_writer.flush()
+        return all(future.succeeded() for future in futures)
+
+    def notify(self, records):
+        # noinspection PyBroadException
+        try:
+            self.on_forward({topic for (topic, _, _), _ in records})
+        except Exception as e:
+            if self.logging:
+                self.logging.error(f'spool forward notification failed: {e}')
+
+    def drain_segment(self, sequence, offset):
+        """ forwards a batch of the segment, returns False when there is nothing to forward """
+        with self.condition:
+            is_active, active_sequence = sequence == self.segment_sequence, self.segment_sequence
+        if not is_active and not os.path.exists(self.segment_path(sequence)):
+            if sequence < active_sequence:
+                self.write_cursor(sequence + 1, 0)
+                return True
+            return False
+        records, rest = self.read(sequence, offset)
+        if len(records) < 1:
+            if is_active:
+                return False
+            if offset + rest < os.path.getsize(self.segment_path(sequence)):
+                # not read to the end, the segment is kept
+                return False
+            if rest > 0 and self.logging:
+                # only the last segment before a restart ends with a partially written record
+                self.logging.error(f'spool segment {sequence} ends with a partial record of {rest} bytes')
+            # the segment is complete, move to the next one
+            os.remove(self.segment_path(sequence))
+            self.write_cursor(sequence + 1, 0)
+            return True
+        if not self.forward(records):
+            if self.logging:
+                self.logging.error(f'unable to forward spool segment {sequence} from {offset}, retrying')
+            self.stop_event.wait(timeout=self.retry_delay)
+            return True
+        self.write_cursor(sequence, records[-1][1])
+        if self.on_forward:
+            self.notify(records)
+        return True
+
+    def drain(self, poll_interval=.1):
+        while not self.stop_event.is_set():
+            sequence, offset = self.cursor
+            # noinspection PyBroadException
+            try:
+                drained = self.drain_segment(sequence, offset)
+            except Exception as e:
+                drained = False
+                if self.logging:
+                    self.logging.error(f'spool drainer failed: {e}', exc_info=True)
+                self.stop_event.wait(timeout=self.retry_delay)
+            if not drained:
+                with self.condition:
+                    self.condition.wait(timeout=poll_interval)
+
+    def close(self, timeout=30):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join(timeout=timeout)
+        with self.condition:
+            if self.segment:
+                self.segment.close()
+                self.segment = None
+
@@ -0,0 +1,81 @@
+import threading
+import time
+
+# noinspection PyPackageRequirements
+from kafka.structs import TopicPartition
+
+from cache.connect import RedisHelper
+
+
+def get_tick_index_key(topic, partition):
+    return f'{topic}:tick-index:{partition}'
+
+
+def get_tick_index_member(tick, offset):
+    # zero padded ticks keep the members of the sorted set ordered by tick
+    return f'{int(tick):020d}:{offset}'
+
+
+class TickIndex:
+    """
+        sampled tick -> offset checkpoints of the topic partitions, kept in the {topic}:tick-index:{partition} redis
+        sorted sets. the first delivered message of a topic in a published chunk is sampled, at most once every
+        interval seconds per partition, and the samples are stored by the publishing thread. the tick of a sample is
+        the highest tick published to the topic up to the sampled message, as the operations of a committed
+        transaction are published after the later operations outside of it
+    """
+
+    def __init__(self, redis_helper: RedisHelper, interval=60, max_entries=10000):
+        self.redis = redis_helper
+        self.interval = interval
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.sampled = {}
+        self.max_ticks = {}
+
+    def track(self, kafka_documents, futures):
+        topics = set()
+        for kafka_document, future in zip(kafka_documents, futures):
+            topic, tick = kafka_document['topic'], int(kafka_document['tick'])
+            self.max_ticks[topic] = max(self.max_ticks.get(topic, tick), tick)
+            if topic not in topics:
+                topics.add(topic)
+                future.add_callback(self.on_delivery, self.max_ticks[topic])
+
+    def on_delivery(self, tick, metadata):
+        partition, now = (metadata.topic, metadata.partition), time.monotonic()
+        with self.lock:
+            if partition in self.sampled and now - self.sampled[partition] < self.interval:
+                return
+            self.sampled[partition] = now
+            self.samples[partition] = (tick, metadata.offset)
+
+    def store(self):
+        with self.lock:
+            samples, self.samples = self.samples, {}
+        if len(samples) < 1:
+            return 0
+        pipeline = self.redis.client.pipeline(transaction=False)
+        for (topic, partition), (tick, offset) in samples.items():
+            key = get_tick_index_key(topic, partition)
+            pipeline.zadd(key, {get_tick_index_member(tick, offset): 0})
+            pipeline.zremrangebyrank(key, 0, -self.max_entries - 1)
+        pipeline.execute()
+        return len(samples)
+
+
+def get_tick_offsets(redis_helper: RedisHelper, topic, partitions, tick):
+    """
+        offsets of the partitions to start from for the messages from the tick, the offset of the last checkpoint
+        before the tick. partitions without such checkpoint are left out
+    """
+    offsets = {}
+    for partition in range(partitions):
+        # the members before the tick, the first is the latest of them
+        members = redis_helper.client.zrevrangebylex(get_tick_index_key(topic, partition), f'({int(tick):020d}', '-',
+                                                     start=0, num=1)
+        if len(members) > 0:
+            member = members[0].decode() if isinstance(members[0], bytes) else members[0]
+            offsets[TopicPartition(topic, partition)] = int(member.split(':')[1])
+    return offsets
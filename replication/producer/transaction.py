@@ -0,0 +1,117 @@
+import tempfile
+from typing import Optional
+
+import msgpack
+import orjson
+
+from replication.producer.reader import LogOpTypes
+
+TRANSACTION_MARKERS = (LogOpTypes.START_TRANSACTION, LogOpTypes.COMMIT_TRANSACTION, LogOpTypes.ABORT_TRANSACTION)
+
+
+def is_transaction_marker(document):
+    return document['type'] in TRANSACTION_MARKERS
+
+
+def get_document_size(document):
+    if 'raw' in document:
+        return len(document['raw'])
+    return len(orjson.dumps(document))
+
+
+class Transaction:
+
+    def __init__(self, tid, first_tick):
+        self.tid = tid
+        self.first_tick = first_tick
+        self.documents = []
+        self.size = 0
+        self.count = 0
+        self.spill_file = None
+
+    def add(self, document, max_memory, spill_dir=None):
+        self.count += 1
+        if self.spill_file:
+            self.spill_file.write(msgpack.packb(document))
+            return
+        self.documents.append(document)
+        self.size += get_document_size(document)
+        if self.size > max_memory:
+            self.spill(spill_dir)
+
+    def spill(self, spill_dir=None):
+        self.spill_file = tempfile.TemporaryFile(prefix=f'transaction-{self.tid}-', dir=spill_dir)
+        for document in self.documents:
+            self.spill_file.write(msgpack.packb(document))
+        self.documents = []
+        self.size = 0
+
+    def read(self):
+        if not self.spill_file:
+            return self.documents
+        self.spill_file.seek(0)
+        documents = list(msgpack.Unpacker(self.spill_file, raw=False))
+        self.close()
+        return documents
+
+    def close(self):
+        if self.spill_file:
+            self.spill_file.close()
+            self.spill_file = None
+
+
+class TransactionBuffer:
+    """
+        holds the wal operations of the open transactions (by tid) until their commit marker, so that only
+        committed operations are published and in commit order. operations of aborted transactions are dropped,
+        transactions larger than max_memory bytes are spilled to a temporary file.
+        operations of transactions whose start marker was not seen are passed through as they are
+    """
+
+    def __init__(self, max_memory=67108864, spill_dir=None):
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.transactions = {}
+        self.committed = 0
+        self.aborted = 0
+        self.spilled = 0
+
+    def add(self, documents):
+        ready = []
+        for document in documents:
+            tid = document.get('tid')
+            document_type = document['type']
+            if document_type == LogOpTypes.START_TRANSACTION:
+                if tid not in self.transactions:
+                    self.transactions[tid] = Transaction(tid, document['tick'])
+            elif document_type == LogOpTypes.COMMIT_TRANSACTION:
+                transaction: Optional[Transaction] = self.transactions.pop(tid, None)
+                if transaction:
+                    self.spilled += 1 if transaction.spill_file else 0
+                    ready.extend(transaction.read())
+                    self.committed += 1
+            elif document_type == LogOpTypes.ABORT_TRANSACTION:
+                transaction: Optional[Transaction] = self.transactions.pop(tid, None)
+                if transaction:
+                    transaction.close()
+                    self.aborted += 1
+            elif tid in self.transactions:
+                self.transactions[tid].add(document, self.max_memory, self.spill_dir)
+            else:
+                ready.append(document)
+        return ready
+
+    def safe_tick(self, tick):
+        """ the tick to resume from without losing the operations of the open transactions """
+        if len(self.transactions) < 1:
+            return tick
+        first_tick = min(int(transaction.first_tick) for transaction in self.transactions.values())
+        return str(min(first_tick - 1, int(tick)))
+
+    def pending(self):
+        return sum(transaction.count for transaction in self.transactions.values())
+
+    def clear(self):
+        for transaction in self.transactions.values():
+            transaction.close()
+        self.transactions = {}
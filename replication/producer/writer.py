@@ -1,3 +1,6 @@
+import threading
+from collections import deque
+
 import msgpack
 from kafka import KafkaProducer
 
@@ -25,6 +28,59 @@ class LogWriter:
         self.producer.close()
 
 
+class AckTracker:
+    """
+        tracks the kafka deliveries of the published wal chunks, the watermark is the last tick of the
+        contiguous run of chunks whose messages are all acknowledged by kafka
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.chunks = deque()
+        self.watermark = None
+        self.error = None
+
+    def track(self, tick, futures):
+        chunk = [tick, len(futures)]
+        with self.condition:
+            self.chunks.append(chunk)
+            self.advance()
+        for future in futures:
+            future.add_callback(self.on_delivery, chunk)
+            future.add_errback(self.on_error)
+
+    def advance(self):
+        while len(self.chunks) > 0 and self.chunks[0][1] == 0:
+            self.watermark = self.chunks.popleft()[0]
+        self.condition.notify_all()
+
+    def on_delivery(self, chunk, _):
+        with self.condition:
+            chunk[1] -= 1
+            self.advance()
+
+    def on_error(self, error):
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
+
+    def in_flight(self):
+        with self.condition:
+            return len(self.chunks)
+
+    def acknowledged(self):
+        with self.condition:
+            if self.error:
+                raise self.error
+            return self.watermark
+
+    def wait(self, max_in_flight, exit_event: threading.Event, poll_interval=.1):
+        with self.condition:
+            while not self.error and len(self.chunks) > max_in_flight and not exit_event.is_set():
+                self.condition.wait(timeout=poll_interval)
+        return self.acknowledged()
+
+
 def get_log_writer(host, port, key_serializer, value_serializer):
     writer = None
 
@@ -0,0 +1,91 @@
+import traceback
+
+import click
+# noinspection PyPackageRequirements
+from kafka import KafkaConsumer
+# noinspection PyPackageRequirements
+from kafka.structs import TopicPartition
+
+from clickhouse.connect import ClickhouseHelper, get_singleton_ch_client
+from replication.consumer.broker import json_decode, get_offset_metadata
+from replication.consumer.dead_letter import get_dead_letter_topic, transform_dead_letters, get_dead_letter_writer
+from replication.consumer.transformer import compile_schema, compile_columnar_schema
+from replication.schema.helper import get_table_map_by_arango_collection
+from util.basic_utils import get_basic_utilities, CONFIG, LOGGER
+
+
+def insert_transformed(clickhouse: ClickhouseHelper, transformed, table, batch_size, columnar=False):
+    if columnar:
+        return clickhouse.bulk_columnar_insert(transformed, table, batch_size)
+    if len(transformed) < 1:
+        return 0
+    return clickhouse.bulk_dict_doc_insert(transformed, table, list(transformed[0].keys()), batch_size)
+
+
+def replay_dead_letters(collection, batch_size):
+    """
+        transforms the dead letters of the collection with the current schema and inserts them, the letters that
+        fail again are published back to the dead-letter topic. the letters published before the replay are read
+        once, the replay group keeps the position across runs
+    """
+    config, logging = get_basic_utilities().get_utils((CONFIG, LOGGER))
+    kafka_config = config['kafka']
+    table_map = get_table_map_by_arango_collection(collection)
+    if table_map is None:
+        logging.error(f'table map of {collection} is not available')
+        return False
+    table = f"{table_map['clickhouse_db']}.{table_map['clickhouse']}"
+    columnar = config['clickhouse'].get('columnar', False)
+    transformer = compile_columnar_schema(table_map['schema']) if columnar else compile_schema(table_map['schema'])
+    clickhouse: ClickhouseHelper = get_singleton_ch_client(config['clickhouse'])
+
+    topic = get_dead_letter_topic(collection)
+    consumer = KafkaConsumer(
+        group_id=f'{topic}-replay',
+        bootstrap_servers=f"{kafka_config['host']}:{kafka_config['port']}",
+        auto_offset_reset='earliest',
+        enable_auto_commit=False,
+        value_deserializer=json_decode,
+    )
+    dead_letter = get_dead_letter_writer(kafka_config, collection)
+    try:
+        partitions = [TopicPartition(topic, partition) for partition in consumer.partitions_for_topic(topic) or []]
+        consumer.assign(partitions)
+        # the letters published back by this replay are after the end offsets
+        end_offsets = consumer.end_offsets(partitions)
+        replayed, failed = 0, 0
+        while any(consumer.position(partition) < end_offsets[partition] for partition in partitions):
+            msg_pack = consumer.poll(timeout_ms=1000, max_records=batch_size)
+            for partition, messages in msg_pack.items():
+                messages = [message for message in messages if message.offset < end_offsets[partition]]
+                if len(messages) < 1:
+                    continue
+                transformed, failed_letters = transform_dead_letters(
+                    transformer, [message.value for message in messages], columnar)
+                replayed += insert_transformed(clickhouse, transformed, table, batch_size, columnar)
+                failed += dead_letter.write(failed_letters)
+                consumer.commit({partition: get_offset_metadata(messages[-1].offset + 1)})
+            logging.info(f'{collection} dead letters replayed: {replayed} docs, failed: {failed} docs')
+    finally:
+        consumer.close()
+        dead_letter.close()
+    return True
+
+
+@click.command()
+@click.option('--collections', '-c', required=True, help='comma separated names of the collections to replay')
+@click.option('--batch-size', '-bs', default=10000)
+def replay(collections, batch_size):
+    logging = get_basic_utilities().get(LOGGER)
+    for collection in collections.split(','):
+        # noinspection PyBroadException
+        try:
+            replay_dead_letters(collection, batch_size)
+        except Exception:
+            logging.error(f'{collection} dead letter replay failed: {traceback.format_exc()}')
+            return False
+    return True
+
+
+if __name__ == '__main__':
+    replay()
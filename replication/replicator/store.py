@@ -6,7 +6,7 @@ from clickhouse_driver import Client
 from arangodb.connect import get_singleton_arango_client, ArangoHelper
 from cache.connect import get_singleton_redis_client
 from clickhouse.connect import ClickhouseHelper, get_singleton_ch_client
-from replication.consumer.transformer import convert_to_ch_dict_using_schema
+from replication.consumer.transformer import compile_schema, compile_columnar_schema
 from replication.producer.reader import get_wal_client
 from replication.schema.helper import get_table_map_by_arango_collection, create_buffer_table
 from util.basic_utils import get_basic_utilities, CONFIG, LOGGER, SMTP_CLIENT
@@ -27,6 +27,34 @@ def create_temporary_table(client: Client, create_command: str, table_name: str,
     return temp_table_name, client.execute(temp_table_create_command)
 
 
+def insert_rows(clickhouse: ClickhouseHelper, transformer, documents, table, batch_size):
+    logging = get_basic_utilities().get(LOGGER)
+    errors = 0
+    for i in range(len(documents)):
+        try:
+            documents[i] = transformer(documents[i])
+        except (TypeError, ValueError, KeyError):
+            logging.document(f'doc: {documents[i]}')
+            logging.document(f'error: {traceback.format_exc()}')
+            documents[i] = None
+            errors += 1
+
+    # filter invalid documents
+    documents = [doc for doc in documents if doc is not None]
+    if len(documents) < 1:
+        return 0, errors
+    return clickhouse.bulk_dict_doc_insert(documents, table, list(documents[0].keys()), batch_size), errors
+
+
+def insert_columns(clickhouse: ClickhouseHelper, transformer, documents, table, batch_size):
+    logging = get_basic_utilities().get(LOGGER)
+    columns, failed_documents = transformer(documents, catch=(TypeError, ValueError, KeyError))
+    for document, error in failed_documents:
+        logging.document(f'doc: {document}')
+        logging.document(f'error: {error}')
+    return clickhouse.bulk_columnar_insert(columns, table, batch_size), len(failed_documents)
+
+
 def load_collection_data(collection, store_tick, batch_size):
     basic_utils = get_basic_utilities()
     config, logging, mail_client = basic_utils.get_utils((CONFIG, LOGGER, SMTP_CLIENT))
@@ -60,27 +88,20 @@ def load_collection_data(collection, store_tick, batch_size):
     logging.info('collect documents from arango')
     processed_documents = 0
     errors = 0
+    columnar = config['clickhouse'].get('columnar', False)
+    transformer = compile_columnar_schema(clickhouse_table_schema) if columnar else compile_schema(
+        clickhouse_table_schema)
     for documents in get_all_documents(db_client=arango_client, col_name=collection, batch_size=batch_size):
         logging.info(f'documents collected fom arango: {len(documents)} docs')
 
-        # map the documents from arango to clickhouse document
-        for i in range(len(documents)):
-            try:
-                documents[i] = convert_to_ch_dict_using_schema(clickhouse_table_schema, documents[i])
-            except (TypeError, ValueError, KeyError):
-                logging.document(f'doc: {documents[i]}')
-                logging.document(f'error: {traceback.format_exc()}')
-                documents[i] = None
-                errors += 1
-
-        # filter invalid documents
-        documents = [doc for doc in documents if doc is not None]
-
-        if len(documents) > 0:
-            total_insertion = clickhouse.bulk_dict_doc_insert(documents, temp_table, list(documents[0].keys()),
-                                                              batch_size)
+        # map the documents from arango to clickhouse documents and insert them
+        insert_documents = insert_columns if columnar else insert_rows
+        total_insertion, failed_documents = insert_documents(clickhouse, transformer, documents, temp_table,
+                                                             batch_size)
+        errors += failed_documents
+        if total_insertion > 0:
             logging.info(f'populated data on clickhouse: {total_insertion} docs')
-            processed_documents += total_insertion
+        processed_documents += total_insertion
         logging.info(f'overall processed documents: {processed_documents} docs')
 
     logging.info('data populated on temporary table')
@@ -8,11 +8,13 @@ from kafka.admin import NewTopic
 
 from cache.connect import get_singleton_redis_client
 from replication.consumer.task import Status
+from replication.producer.checkpoint import reset_journal
 from replication.replicator.pm2 import PM2, get_config_path, generate_config_file
 from replication.replicator.store import load_collection_data
-from replication.schema.helper import get_table_map_by_arango_collection
+from replication.schema.helper import get_table_map_by_arango_collection, get_topic_partitions
 from taskmanager import TaskManager
 from util.basic_utils import get_basic_utilities, CONFIG, LOGGER
+from util.common import get_consumer_task, SHARED_CONSUMER
 
 
 def delete_topics(topics, time_out=10):
@@ -61,7 +63,7 @@ def create_topic(table):
     custom_topic_configs = table_map['topic_config'] if 'topic_config' in table_map else {}
     topic_config = {
         'name': table,
-        'num_partitions': 1,
+        'num_partitions': get_topic_partitions(table_map),
         'replication_factor': 1,
         'topic_configs': custom_topic_configs
     }
@@ -72,6 +74,16 @@ def create_topic(table):
     return True
 
 
+def start_consumer_task(task_manager: TaskManager, task):
+    logging = get_basic_utilities().get(LOGGER)
+    if task_manager.ping(task):
+        result = task_manager.start_task(task)
+        if result == Status.ACTIVE.name:
+            logging.info(f'{task} consumer process started')
+        else:
+            logging.error('unable to start consumer, restarting using pm2')
+
+
 def synchronizer(tables, clear):
     config, logging = get_basic_utilities().get_utils((CONFIG, LOGGER))
     redis_config = config['redis']
@@ -91,6 +103,7 @@ def synchronizer(tables, clear):
     # clear redis cache db if specified
     if clear:
         redis_helper.client.flushdb()
+        reset_journal(config['producer'].get('checkpoint_journal', 'last-tick.journal'))
         logging.info('redis cache cleared')
     else:
         # delete consumer specific keys
@@ -103,18 +116,19 @@ def synchronizer(tables, clear):
         logging.error('unable to stop producer')
         return False
 
-    # stop the consumer process
-    for table in tables:
-        consumer_active = task_manager.ping(table)
+    # stop the consumer process, the shared consumers are stopped once
+    consumer_tasks = list(dict.fromkeys(get_consumer_task(table) for table in tables))
+    for task in consumer_tasks:
+        consumer_active = task_manager.ping(task)
         if consumer_active:
-            result = task_manager.stop_task(table)
+            result = task_manager.stop_task(task)
             if result == Status.INACTIVE.name:
-                logging.info(f'stopped the consumer {table}')
+                logging.info(f'stopped the consumer {task}')
             else:
-                logging.error(f'unable to stop consumer {table}')
+                logging.error(f'unable to stop consumer {task}')
                 return False
         else:
-            logging.info(f'consumer {table} not active')
+            logging.info(f'consumer {task} not active')
 
     # delete topics
     all_deleted = delete_topics(tables)
@@ -143,13 +157,12 @@ def synchronizer(tables, clear):
             logging.error(f'failed to load {table} data')
             return False
 
-        # start the consumer
-        if task_manager.ping(table):
-            result = task_manager.start_task(table)
-            if result == Status.ACTIVE.name:
-                logging.info(f'{table} consumer process started')
-            else:
-                logging.error('unable to start consumer, restarting using pm2')
+        # start the consumer, the shared consumer is started once all its tables are loaded
+        if get_consumer_task(table) != SHARED_CONSUMER:
+            start_consumer_task(task_manager, table)
+
+    if SHARED_CONSUMER in consumer_tasks:
+        start_consumer_task(task_manager, SHARED_CONSUMER)
 
     if consumer_process.restart():
         logging.info('pm2 consumer restarted')
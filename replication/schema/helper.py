@@ -35,6 +35,8 @@ def get_table_map(table):
         schema['buffer'] = table_config['buffer']
     if 'topic_config' in table_config:
         schema['topic_config'] = table_config['topic_config']
+    if 'partitions' in table_config:
+        schema['partitions'] = table_config['partitions']
     return schema
 
 
@@ -70,6 +72,20 @@ def supported_clickhouse_collections() -> List[str]:
     return [table_map['clickhouse'] for table_map in get_schemas_map()]
 
 
+def get_referenced_attributes(table_map) -> set:
+    """ attributes of the arango document read by the table schema """
+    properties = table_map['schema']['properties']
+    attributes = {properties[key]['ref'] if 'ref' in properties[key] else key for key in properties}
+    return attributes | {'_key', '_rev'}
+
+
+def get_topic_partitions(table_map) -> int:
+    if 'partitions' in table_map:
+        return table_map['partitions']
+    config = get_basic_utilities().get(CONFIG)
+    return config['kafka'].get('partitions', 1)
+
+
 def get_primary_key(consumer):
     table_map = get_table_map_by_arango_collection(consumer)
     schema = table_map['schema']
@@ -3,6 +3,18 @@ def handle_to_array(value):
     return value.strip().split(',')
 
 
+def handle_to_array_batch(values):
+    assert all(isinstance(value, str) for value in values)
+    return [value.strip().split(',') for value in values]
+
+
 custom_transformers = {
     'to_array': handle_to_array
 }
+
+# batch transformers get the list of the values of a column and return the list of the transformed values. they are
+# used by the columnar transform only (clickhouse.columnar: true), the row transform calls a type registered only here
+# with a list of one value per document, so register the per value form in custom_transformers as well
+custom_batch_transformers = {
+    'to_array': handle_to_array_batch
+}
@@ -9,7 +9,7 @@ from rich.table import Table
 from cache.connect import RedisHelper, get_singleton_redis_client
 from replication.consumer.task import Status
 from util.basic_utils import get_basic_utilities, CONFIG, LOGGER
-from util.common import get_supported_consumers
+from util.common import get_consumer_tasks
 
 
 class TaskManager:
@@ -154,7 +154,7 @@ def handle_consumers(consumers, option):
 @click.option('-stop', is_flag=True, help='Stop the consumer')
 @click.option('-restart', is_flag=True, help='Restart the consumer')
 @click.option('-info', is_flag=True, help='Details of the consumer')
-@click.option('-consumer', '-c', type=click.Choice(get_supported_consumers()), help='Name of consumer')
+@click.option('-consumer', '-c', type=click.Choice(get_consumer_tasks()), help='Name of consumer')
 def main(status, start, stop, restart, info, consumer):
     console = Console()
     options = [(info, 'INFO'), (start, Status.ACTIVE.name), (stop, Status.INACTIVE.name),
@@ -170,7 +170,7 @@ def main(status, start, stop, restart, info, consumer):
         console.print('[bold red] too many options [/[bold red]]')
         return False
     option_set = options_provided[0]
-    consumers = [consumer] if consumer else get_supported_consumers()
+    consumers = [consumer] if consumer else get_consumer_tasks()
     handle_consumers(consumers, option_set)
 
 
@@ -47,3 +47,26 @@ def test_none_values(basic_utilities):
     clickhouse_doc = convert_to_ch_dict_using_schema(table_map['schema'], doc)
     result = ch_client.insert_dict(clickhouse_doc, table)
     assert result == 1
+
+
+class MockClient:
+
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, query, data, columnar=False, settings=None):
+        self.queries.append((query, data, columnar, settings))
+
+
+def test_bulk_columnar_insert():
+    clickhouse = ClickhouseHelper(None)
+    clickhouse.client = MockClient()
+    columns = {'_key': ['1', '2', '3'], 'Id': [1, 2, 3]}
+    settings = {'insert_deduplicate': 1, 'insert_deduplication_token': 't1:0:1-3'}
+    assert clickhouse.bulk_columnar_insert(columns, 'db.t1', 2, settings) == 3
+    # the columns are inserted as they are, a deduplication token per batch
+    assert clickhouse.client.queries == [
+        ('INSERT INTO db.t1 (_key,Id) VALUES', [['1', '2'], [1, 2]], True,
+         {'insert_deduplicate': 1, 'insert_deduplication_token': 't1:0:1-3:0'}),
+        ('INSERT INTO db.t1 (_key,Id) VALUES', [['3'], [3]], True,
+         {'insert_deduplicate': 1, 'insert_deduplication_token': 't1:0:1-3:1'})]
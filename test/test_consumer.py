@@ -1,6 +1,19 @@
+import threading
+import time
+from collections import namedtuple
 from datetime import datetime
 
-from replication.consumer.loader import pre_process_documents
+import pytest
+# noinspection PyPackageRequirements
+from kafka.structs import TopicPartition
+from redis.exceptions import RedisError
+
+from replication.consumer.broker import OffsetMigrationListener, LagTracker, json_decode, get_offset_metadata
+from replication.consumer.dead_letter import get_dead_letters, transform_dead_letters
+from replication.consumer.loader import pre_process_documents, coalesce_documents, log_processed_documents, \
+    log_error_documents, ConsumerPipeline, InsertAccumulator, wait_for_wake, pre_process_records, InsertRanges, \
+    get_partition_workers
+from replication.consumer.task import Process, get_process_context
 
 
 def test_pre_process_documents():
@@ -35,3 +48,402 @@ def test_pre_process_documents():
          "_ver": int(f"{today}3"), "_deleted": 1},
     ]
     assert result == expected
+
+
+def test_pre_process_documents_tick_version():
+    docs = [
+        {"doc": {"tick": "1617000000000000001", "type": 2300, "data": {"_key": "1"}}, "offset": 7},
+        {"doc": {"tick": "1617000000000000002", "type": 2302, "data": {"_key": "1"}}, "offset": 3},
+    ]
+    result = pre_process_documents(None, docs, version_from_tick=True)
+    assert result == [{"_key": "1", "_ver": 1617000000000000001, "_deleted": 0},
+                      {"_key": "1", "_ver": 1617000000000000002, "_deleted": 1}]
+
+
+def test_pre_process_records():
+    record = namedtuple('Record', ['offset', 'value'])
+    messages = [record(5, json_decode(b'{"tick": "99", "type": 2300, "data": {"_key": "1"}}')),
+                record(6, json_decode(None)),
+                record(7, json_decode(b'{"tick": "100", "type": 2302, "data": {"_key": "2"}}'))]
+    today = datetime.utcnow().strftime('%Y%j')
+    assert pre_process_records(b'100', messages) == [{"_key": "2", "_ver": int(f"{today}7"), "_deleted": 1}]
+
+
+def test_coalesce_documents():
+    documents = [{'_key': '1', '_ver': 1}, {'_key': '2', '_ver': 2}, {'_key': '1', '_ver': 3, '_deleted': 1},
+                 {'_key': '3', '_ver': 4}, {'_key': '2', '_ver': 5}]
+    assert coalesce_documents(documents) == [{'_key': '1', '_ver': 3, '_deleted': 1}, {'_key': '3', '_ver': 4},
+                                             {'_key': '2', '_ver': 5}]
+
+
+class MockLogger:
+
+    def __init__(self):
+        self.lines = []
+
+    def info(self, line):
+        self.lines.append(line)
+
+    def document(self, line):
+        self.lines.append(line)
+
+    def error(self, line):
+        self.lines.append(line)
+
+
+def test_log_processed_documents():
+    keys, versions = [str(key) for key in range(10)], list(range(100, 110))
+    audit = {}
+    for mode in ('all', 'sample', 'summary', 'off'):
+        audit[mode] = MockLogger()
+        log_processed_documents(audit[mode], 'w', keys, versions, (mode, 4))
+    assert len(audit['all'].lines) == 10 and audit['off'].lines == []
+    assert audit['sample'].lines == ['w: processed: 0, ver: 100', 'w: processed: 4, ver: 104',
+                                     'w: processed: 8, ver: 108']
+    assert audit['summary'].lines == ['w: processed 10 docs: 0...9, ver: 100-109']
+
+
+def test_log_error_documents():
+    errors = [({'_key': str(key)}, 'ValueError') for key in range(10)]
+    audit = {}
+    for mode in ('all', 'sample', 'summary', 'off'):
+        audit[mode] = MockLogger()
+        log_error_documents(audit[mode], errors, (mode, 4))
+    assert len(audit['all'].lines) == 20 and audit['off'].lines == []
+    assert audit['sample'].lines[::2] == ["doc: {'_key': '0'}", "doc: {'_key': '4'}", "doc: {'_key': '8'}"]
+    assert audit['summary'].lines == ["10 failed docs, first doc: {'_key': '0'}", 'error: ValueError']
+
+
+class MockPublisher:
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, channel, message):
+        self.messages.append((channel, message))
+
+
+def finish(stop_event):
+    stop_event.wait(timeout=.01)
+
+
+def fail(_):
+    raise ValueError('worker failed')
+
+
+def test_process_worker():
+    redis = MockPublisher()
+    context = get_process_context()
+    completed = Process(target=finish, name='c1', args=(context.Event(),), kwargs={}, redis=redis)
+    failed = Process(target=fail, name='c2', args=(context.Event(),), kwargs={}, redis=redis)
+    for worker in (completed, failed):
+        worker.start()
+        worker.join()
+    assert redis.messages == [('c1:manager', 'COMPLETE'), ('c2:manager', 'ERROR')]
+    assert isinstance(failed.exc, Exception) and 'worker failed' in failed.trace
+
+
+class MockConsumer:
+
+    def __init__(self, committed):
+        self.committed_offsets = committed
+        self.positions = {}
+
+    def committed(self, partition):
+        return self.committed_offsets.get(partition)
+
+    def seek(self, partition, offset):
+        self.positions[partition] = offset
+
+
+def test_offset_migration_listener():
+    p0, p1, p2 = TopicPartition('t1', 0), TopicPartition('t1', 1), TopicPartition('t2', 0)
+    revoked = []
+    listener = OffsetMigrationListener({p0: 10, p1: 20}, revoked.append)
+    listener.consumer = MockConsumer({p1: 25})
+    listener.on_partitions_assigned([p0, p1, p2])
+    assert listener.consumer.positions == {p0: 10}
+    listener.on_partitions_revoked([p2])
+    assert revoked == [{p2}]
+
+
+class MockTableConsumer:
+
+    def __init__(self):
+        self.inserted = []
+        self.settings = []
+        self.insert_ranges = None
+
+    @staticmethod
+    def transform(_, partition, messages, __):
+        if partition.partition == 1:
+            raise ValueError('transform failed')
+        return [message.value for message in messages]
+
+    def recover(self, partition, messages):
+        if self.insert_ranges is None:
+            return [], messages
+        return self.insert_ranges.recover(partition, messages)
+
+    def get_insert_settings(self, partition, first_offset, last_offset):
+        if self.insert_ranges is None:
+            return None
+        return self.insert_ranges.store(partition, first_offset, last_offset)
+
+    def committed(self, offsets):
+        for partition, offset in offsets.items():
+            self.insert_ranges.trim(partition, offset.offset)
+
+    def insert(self, _, transformed, __, settings=None):
+        self.settings.append(settings)
+        self.inserted.extend(transformed)
+        return len(transformed)
+
+
+def test_consumer_pipeline():
+    record = namedtuple('Record', ['offset', 'value'])
+    table_consumer, p0, p1 = MockTableConsumer(), TopicPartition('t1', 0), TopicPartition('t1', 1)
+    pipeline = ConsumerPipeline(table_consumer, 'w', MockLogger(), queue_size=1).start()
+    pipeline.put(p0, [record(1, 'a'), record(2, 'b')])
+    pipeline.put(p0, [record(3, 'c')])
+    assert pipeline.hand() and not pipeline.is_idle()
+    offsets = {}
+    while not pipeline.is_idle():
+        pipeline.hand()
+        offsets.update(pipeline.inserted())
+        time.sleep(.01)
+    assert table_consumer.inserted == ['a', 'b', 'c'] and offsets[p0].offset == 4
+    pipeline.put(p1, [record(5, 'd')])
+    pipeline.hand()
+    with pytest.raises(ValueError):
+        while True:
+            pipeline.inserted()
+            time.sleep(.01)
+    pipeline.close()
+
+
+def test_consumer_pipeline_revoke():
+    record = namedtuple('Record', ['offset', 'value'])
+    table_consumer, p0, p2 = MockTableConsumer(), TopicPartition('t1', 0), TopicPartition('t1', 2)
+    pipeline = ConsumerPipeline(table_consumer, 'w', MockLogger(), queue_size=1).start()
+    pipeline.put(p0, [record(1, 'a')])
+    pipeline.put(p2, [record(1, 'b')])
+    pipeline.put(p2, [record(2, 'c')])
+    pipeline.hand()
+    # the pending batches of the revoked partition are dropped and the batches in flight are not committed
+    pipeline.revoke({p0, p2})
+    offsets = {}
+    while not pipeline.is_idle():
+        offsets.update(pipeline.inserted())
+        time.sleep(.01)
+    assert offsets == {} and table_consumer.inserted == ['a']
+    pipeline.put(p0, [record(1, 'a')])
+    while not pipeline.is_idle():
+        pipeline.hand()
+        offsets.update(pipeline.inserted())
+        time.sleep(.01)
+    assert offsets[p0].offset == 2
+    pipeline.close()
+
+
+def test_consumer_pipeline_drain():
+    record = namedtuple('Record', ['offset', 'value'])
+    table_consumer, p0 = MockTableConsumer(), TopicPartition('t1', 0)
+    # a pipeline which is not started is closed
+    ConsumerPipeline(table_consumer, 'w', MockLogger()).close()
+    pipeline = ConsumerPipeline(table_consumer, 'w', MockLogger(), queue_size=1).start()
+    pipeline.put(p0, [record(1, 'a')])
+    pipeline.put(p0, [record(2, 'b')])
+    pipeline.hand()
+    # the pending batches and the batches in flight are inserted before stopping
+    offsets = pipeline.drain(timeout=10)
+    assert pipeline.is_idle() and table_consumer.inserted == ['a', 'b'] and offsets[p0].offset == 3
+    pipeline.close()
+
+
+class MockPartsClient:
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def get_max_active_parts(self, *_):
+        return self.parts
+
+
+def test_insert_accumulator():
+    table_consumer, p0, p1 = MockTableConsumer(), TopicPartition('t1', 0), TopicPartition('t1', 1)
+    table_consumer.table_map = {'clickhouse_db': 'db', 'clickhouse': 't1'}
+    table_consumer.ch_client = MockPartsClient(500)
+    accumulator = InsertAccumulator(table_consumer, max_rows=3, max_bytes=100, max_age=60, parts_interval=0)
+    accumulator.add(p0, 3, ['a', 'b'], 10)
+    accumulator.add(p1, 8, [], 10)
+    assert not accumulator.is_ready()
+    accumulator.add(p0, 5, ['c'], 10)
+    assert accumulator.is_ready()
+    offsets = accumulator.flush('w', MockLogger())
+    assert table_consumer.inserted == ['a', 'b', 'c'] and {p: o.offset for p, o in offsets.items()} == {p0: 5, p1: 8}
+    # the thresholds grow while the table has too many parts
+    assert accumulator.scale == 2 and accumulator.is_empty()
+    table_consumer.ch_client.parts = 0
+    accumulator.add(p0, 9, [{'Id': 1}], 10)
+    accumulator.adapt(10, 'w', MockLogger())
+    assert accumulator.scale == 1
+
+
+class MockRedis:
+
+    def __init__(self):
+        self.client = self
+        self.values = {}
+        self.fail = False
+
+    def hset(self, name, mapping):
+        if self.fail:
+            raise RedisError('connection refused')
+        self.values.setdefault(name, {}).update(mapping)
+
+    def hget(self, name, key):
+        return self.values.get(name, {}).get(key)
+
+
+class MockLagConsumer:
+
+    def __init__(self, highwater, positions, end_offsets):
+        self.highwaters, self.positions, self.end_offset_requests = highwater, positions, []
+        self.broker_end_offsets = end_offsets
+
+    def assignment(self):
+        return set(self.positions.keys())
+
+    def highwater(self, partition):
+        return self.highwaters.get(partition)
+
+    def position(self, partition):
+        return self.positions[partition]
+
+    def end_offsets(self, partitions):
+        self.end_offset_requests.append(partitions)
+        return {partition: self.broker_end_offsets[partition] for partition in partitions}
+
+
+def test_lag_tracker():
+    p0, p1 = TopicPartition('t1', 0), TopicPartition('t1', 1)
+    consumer = MockLagConsumer({p0: 10}, {p0: 10, p1: 3}, {p1: 5})
+    redis = MockRedis()
+    lag_tracker = LagTracker(consumer, refresh_interval=60, redis=redis, name='t1')
+    assert lag_tracker.lags() == {p0: 0, p1: 2} and not lag_tracker.is_consumed()
+    # the end offsets are requested once per interval
+    assert consumer.end_offset_requests == [[p1]] and redis.values['t1:lag'] == {'t1:0': 0, 't1:1': 2}
+    consumer.highwaters[p1], consumer.positions[p1] = 6, 6
+    assert lag_tracker.is_consumed() and len(consumer.end_offset_requests) == 1
+    # a failed publish does not fail the consumer
+    redis.fail, lag_tracker.published, logger = True, None, MockLogger()
+    lag_tracker.logging = logger
+    assert lag_tracker.lags() == {p0: 0, p1: 0} and 'unable to publish' in logger.lines[-1]
+
+
+def test_get_partition_workers():
+    logger = MockLogger()
+    assert get_partition_workers('t1', 2, None, logger) == 2 and len(logger.lines) == 0
+    assert get_partition_workers('t1', 2, 2, logger) == 2 and len(logger.lines) == 0
+    # the partitions of the topic are consumed when the configuration differs
+    assert get_partition_workers('t1', 2, 4, logger) == 4 and '4 partitions' in logger.lines[-1]
+
+
+def test_wait_for_wake():
+    stop_event, wake_event = threading.Event(), threading.Event()
+    start = time.monotonic()
+    assert not wait_for_wake(stop_event, wake_event, .2) and time.monotonic() - start >= .2
+    threading.Timer(.1, wake_event.set).start()
+    start = time.monotonic()
+    assert wait_for_wake(stop_event, wake_event, 10) and time.monotonic() - start < 5
+    # the notification is consumed by the wake
+    assert not wake_event.is_set()
+    stop_event.set()
+    assert not wait_for_wake(stop_event, wake_event, 10)
+
+
+def test_dead_letters():
+    documents = [{'_key': '1', 'attr': 'a'}, {'_key': '2', 'attr': 2}]
+    letters = get_dead_letters(0, [(documents[0], 'invalid literal')], {id(document): offset for document, offset in
+                                                                        zip(documents, (4, 5))})
+    assert letters == [{'doc': documents[0], 'error': 'invalid literal', 'partition': 0, 'offset': 4}]
+
+    def transformer(document):
+        return {'Id': int(document['_key']), 'Attr': int(document['attr'])}
+
+    letters.append({'doc': documents[1], 'error': 'fixed', 'partition': 0, 'offset': 5})
+    transformed, failed = transform_dead_letters(transformer, letters)
+    assert transformed == [{'Id': 2, 'Attr': 2}]
+    assert len(failed) == 1 and failed[0]['offset'] == 4 and 'ValueError' in failed[0]['error']
+
+
+def test_insert_ranges():
+    record = namedtuple('Record', ['offset', 'value'])
+    redis, p0, p1 = MockRedis(), TopicPartition('t1', 0), TopicPartition('t1', 1)
+    insert_ranges = InsertRanges(redis, 't1')
+    settings = insert_ranges.store(p0, 10, 12)
+    assert settings['insert_deduplication_token'] == 't1:0:10-12'
+    insert_ranges.store(p0, 13, 14)
+    assert redis.values['t1:insert-ranges'] == {'t1:0': '10-12,13-14'}
+    # after a restart the records are held until every stored range is polled again
+    insert_ranges = InsertRanges(redis, 't1')
+    messages = [record(offset, None) for offset in range(10, 17)]
+    assert insert_ranges.recover(p0, messages[:3]) == ([], [])
+    batches, rest = insert_ranges.recover(p0, messages[3:])
+    assert [[m.offset for m in batch] for batch in batches] == [[10, 11, 12], [13, 14]]
+    assert [m.offset for m in rest] == [15, 16]
+    assert insert_ranges.recover(p0, messages) == ([], messages)
+    assert insert_ranges.recover(p1, messages) == ([], messages)
+    # the committed ranges are dropped
+    insert_ranges.trim(p0, 13)
+    assert redis.values['t1:insert-ranges'] == {'t1:0': '13-14'}
+    # the ranges before the polled position are committed already
+    assert InsertRanges(redis, 't1').recover(p0, messages[5:]) == ([], messages[5:])
+    # the held records are released after the hold timeout
+    insert_ranges = InsertRanges(redis, 't1', hold_timeout=0)
+    assert insert_ranges.recover(p0, messages[3:4]) == ([], messages[3:4])
+
+
+def test_insert_ranges_concurrent_trim():
+    redis, p0 = MockRedis(), TopicPartition('t1', 0)
+    insert_ranges = InsertRanges(redis, 't1')
+
+    def store():
+        for offset in range(0, 2000, 2):
+            insert_ranges.store(p0, offset, offset + 1)
+
+    thread = threading.Thread(target=store)
+    thread.start()
+    while thread.is_alive():
+        insert_ranges.trim(p0, 1000)
+    thread.join()
+    insert_ranges.trim(p0, 1000)
+    # the ranges stored during the trims are kept
+    assert redis.values['t1:insert-ranges']['t1:0'] == ','.join(f'{offset}-{offset + 1}' for offset in
+                                                                 range(1000, 2000, 2))
+
+
+def test_insert_ranges_accumulator_restart():
+    record = namedtuple('Record', ['offset', 'value'])
+    redis, p0 = MockRedis(), TopicPartition('t1', 0)
+    table_consumer = MockTableConsumer()
+    table_consumer.table_map = {'clickhouse_db': 'db', 'clickhouse': 't1'}
+    table_consumer.ch_client = MockPartsClient(0)
+    table_consumer.insert_ranges = InsertRanges(redis, 't1')
+    accumulator = InsertAccumulator(table_consumer, max_rows=10, max_age=60)
+    messages = [record(offset, {'Id': offset}) for offset in range(10, 20)]
+    for batch in (messages[:5], messages[5:]):
+        accumulator.add(p0, batch[-1].offset + 1, [m.value for m in batch], 10, first_offset=batch[0].offset)
+    accumulator.flush('w', MockLogger())
+    assert table_consumer.settings[-1]['insert_deduplication_token'] == 't1:0:10-19'
+
+    # the offsets are not committed before the restart, the range is polled again in smaller batches
+    table_consumer.inserted, table_consumer.insert_ranges = [], InsertRanges(redis, 't1')
+    assert table_consumer.insert_ranges.recover(p0, messages[:5]) == ([], [])
+    batches, rest = table_consumer.insert_ranges.recover(p0, messages[5:])
+    assert len(batches) == 1 and len(rest) == 0
+    settings = table_consumer.get_insert_settings(p0, batches[0][0].offset, batches[0][-1].offset)
+    assert settings['insert_deduplication_token'] == 't1:0:10-19'
+    table_consumer.committed({p0: get_offset_metadata(batches[0][-1].offset + 1)})
+    assert redis.values['t1:insert-ranges'] == {'t1:0': ''}
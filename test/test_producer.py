@@ -1,8 +1,25 @@
+import threading
+import time
+from collections import namedtuple
+
+import orjson
+import pytest
+# noinspection PyPackageRequirements
+from kafka.future import Future
+# noinspection PyPackageRequirements
+from kafka.structs import TopicPartition
 from pyArango.collection import Collection
 
 from cache.connect import get_singleton_redis_client
-from replication.producer.publisher import set_tick_if_not_set, collect_logs, get_arango_collections
-from replication.producer.reader import get_wal_client, LogGenerator
+from replication.producer.checkpoint import TickCheckpoint, read_journal_tick
+from replication.producer.publisher import set_tick_if_not_set, collect_logs, get_arango_collections, \
+    project_documents, IdleBackoff, get_publish_lag
+from replication.producer.reader import get_wal_client, LogGenerator, LogPrefetcher, scan_logs, parse_log, \
+    ChunkSizer, json_encode, tick_to_timestamp
+from replication.producer.spool import LogSpool
+from replication.producer.tick_index import TickIndex, get_tick_offsets, get_tick_index_member
+from replication.producer.transaction import TransactionBuffer
+from replication.producer.writer import AckTracker
 from util.basic_utils import CONFIG
 # noinspection PyUnresolvedReferences
 from .test_arango import temp_empty_table
@@ -56,3 +73,264 @@ def test_log_generator_retry(basic_utilities, temp_empty_table: Collection):
         t3.extend(docs['content'])
         logs_generator.is_processed(True)
     return t1 == t2 and len(t3) < 1
+
+
+def mock_logs(chunks):
+    tick = 0
+    for index, size in enumerate(chunks):
+        content = [{'tick': str(tick + i + 1)} for i in range(size)]
+        tick += size
+        is_processed = yield {'content': content, 'last_included': str(tick), 'check_more': index < len(chunks) - 1}
+        assert is_processed
+
+
+def test_log_prefetcher_order():
+    prefetcher = LogPrefetcher(LogGenerator(mock_logs([2, 3, 1, 4])), 2, threading.Event()).start()
+    ticks = []
+    for docs in prefetcher:
+        ticks.extend(int(doc['tick']) for doc in docs['content'])
+        prefetcher.is_processed(True)
+    prefetcher.close()
+    assert ticks == list(range(1, 11))
+
+
+def test_scan_logs():
+    content = '\n'.join([
+        '{"tick":"11","type":2200,"db":"db","tid":"5"}',
+        '{"tick":"12","type":2300,"db":"db","cuid":"c1","tid":"5","data":{"_key":"1","name":"\\"data\\":{"}}',
+        '{"tick":"13","type":2302,"db":"db","cuid":"c1","tid":"0","data":{"_key":"2","_rev":"_c"}}',
+        '{"type":2300,"tick":"14","db":"db","cuid":"c2","data":{"name":"t1","_key":"3"}}',
+    ]) + '\n'
+    documents = scan_logs(content)
+    assert documents == [parse_log(line) for line in content.split('\n') if line]
+    assert [(d['tick'], d['type'], d['cuid'], d['key']) for d in documents] == [
+        ('11', 2200, None, None), ('12', 2300, 'c1', '1'), ('13', 2302, 'c1', '2'), ('14', 2300, 'c2', '3')]
+
+
+def test_ack_tracker_watermark():
+    tracker = AckTracker()
+    first, second, third = [Future(), Future()], [], [Future()]
+    tracker.track('10', first)
+    tracker.track('20', second)
+    tracker.track('30', third)
+    third[0].success(None)
+    first[0].success(None)
+    assert tracker.acknowledged() is None and tracker.in_flight() == 3
+    first[1].success(None)
+    assert tracker.wait(0, threading.Event()) == '30'
+    failed = [Future()]
+    tracker.track('40', failed)
+    failed[0].failure(ValueError('not delivered'))
+    with pytest.raises(ValueError):
+        tracker.wait(0, threading.Event())
+
+
+def test_chunk_sizer_bounds():
+    chunk_sizer = ChunkSizer(1000, 500, 4000, target_latency=1)
+    fast = {'size': 1000, 'entries': 10, 'fetch_time': .01, 'check_more': True}
+    assert chunk_sizer.update(fast, .01) == 2000
+    assert chunk_sizer.update({**fast, 'size': 2000, 'entries': 20}, .02) == 4000
+    assert chunk_sizer.update({**fast, 'check_more': False}, 10) == 4000
+    slow = {'size': 4000, 'entries': 40, 'fetch_time': 5, 'check_more': True}
+    assert chunk_sizer.update(slow, 5) == 2000
+    assert chunk_sizer.update(slow, 5) == 1000
+    assert 500 <= chunk_sizer.update(slow, 5) < 1000
+
+
+def test_idle_backoff():
+    idle_backoff = IdleBackoff(.5, 4)
+    assert [idle_backoff.next() for _ in range(5)] == [.5, 1, 2, 4, 4]
+    idle_backoff.reset()
+    assert idle_backoff.next() == .5
+    # min idle is bounded by max idle
+    assert IdleBackoff(10, 4).next() == 4
+
+
+def test_publish_lag():
+    now = time.time()
+    tick = str(int((now - 2) * 1000) << 20 | 12345)
+    assert abs(tick_to_timestamp(tick) - (now - 2)) < .01
+    assert get_publish_lag({'content': []}) is None
+    assert 1.9 < get_publish_lag({'content': [{'tick': '1'}, {'tick': tick}]}) < 3
+    # ticks ahead of the local clock have no lag
+    assert get_publish_lag({'content': [{'tick': str(int((now + 60) * 1000) << 20)}]}) == 0
+    # the lag is stored by the checkpoint thread
+    redis = MockRedis()
+    checkpoint = TickCheckpoint(redis, None, interval=60)
+    checkpoint.set_publish_lag(2.0004, tick)
+    assert checkpoint.write_publish_lag() and redis.values['producer:lag'] == {'publish_lag': 2.0, 'tick': tick}
+    assert not checkpoint.write_publish_lag()
+
+
+class MockRedis:
+
+    def __init__(self, values=None):
+        self.client = self
+        self.values = values if values else {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = str(value).encode()
+        return True
+
+    def hset(self, key, mapping):
+        self.values.setdefault(key, {}).update(mapping)
+
+    def pipeline(self, **_):
+        return self
+
+    def execute(self):
+        return []
+
+    def zadd(self, key, mapping):
+        self.values.setdefault(key, set()).update(member.encode() for member in mapping)
+
+    def zremrangebyrank(self, key, start, end):
+        members = sorted(self.values[key])
+        self.values[key] = set(members[:start] + members[end + 1:] if end < -1 else members[:start])
+
+    def zrevrangebylex(self, key, maximum, minimum, start, num):
+        self.values.setdefault('lex_queries', []).append((key, maximum, minimum, start, num))
+        return self.values.get(f'{key}:lex', [])[start:start + num]
+
+
+def test_tick_checkpoint_recovery(tmp_path):
+    journal = str(tmp_path.joinpath('last-tick.journal'))
+    redis = MockRedis({'last-tick': b'100'})
+    checkpoint = TickCheckpoint(redis, journal, interval=60, max_pending=2)
+    assert checkpoint.recover() == 100 and read_journal_tick(journal) == 100
+    checkpoint.start()
+    checkpoint.commit('110')
+    checkpoint.commit('120')
+    checkpoint.close()
+    assert read_journal_tick(journal) == 120 and redis.get('last-tick') == b'120'
+    stale_redis = MockRedis({'last-tick': b'105'})
+    assert TickCheckpoint(stale_redis, journal).recover() == 120 and stale_redis.get('last-tick') == b'120'
+
+
+def test_transaction_buffer():
+    def log(tick, log_type, tid, key=None):
+        document = {'tick': str(tick), 'type': log_type, 'tid': tid}
+        return {**document, 'cuid': 'c1', 'data': {'_key': key}} if key else document
+
+    buffer = TransactionBuffer(max_memory=100)
+    ready = buffer.add([log(1, 2200, '5'), log(2, 2300, '5', 'a'), log(3, 2300, '0', 'b'), log(4, 2200, '6'),
+                        log(5, 2300, '6', 'c'), log(6, 2300, '6', 'd')])
+    assert [d['data']['_key'] for d in ready] == ['b']
+    assert buffer.safe_tick('6') == '0' and buffer.pending() == 3
+    ready = buffer.add([log(7, 2202, '5'), log(8, 2300, '6', 'e'), log(9, 2201, '6'), log(10, 2300, '9', 'f')])
+    assert [d['data']['_key'] for d in ready] == ['c', 'd', 'e', 'f']
+    assert buffer.safe_tick('10') == '10' and buffer.spilled == 1 and buffer.aborted == 1
+
+
+def test_project_documents():
+    projections = {'c1': {'_key', '_rev', 'name'}}
+    content = [
+        {'tick': '1', 'type': 2300, 'cuid': 'c1', 'data': {'_key': '1', '_rev': 'r', 'name': 'n', 'blob': 'x' * 10}},
+        parse_log('{"tick":"2","type":2300,"cuid":"c1","data":{"_key":"2","blob":[1,2],"name":"m"}}'),
+        {'tick': '3', 'type': 2300, 'cuid': 'c2', 'data': {'_key': '3', 'blob': 'y'}},
+    ]
+    documents = project_documents(content, projections)
+    assert documents[0]['data'] == {'_key': '1', '_rev': 'r', 'name': 'n'}
+    assert orjson.loads(documents[1]['raw'])['data'] == {'_key': '2', 'name': 'm'}
+    assert documents[2]['data'] == {'_key': '3', 'blob': 'y'}
+
+
+class MockLogWriter:
+
+    def __init__(self, fail=0):
+        self.messages = []
+        self.fail = fail
+
+    def write(self, topic, value, key=None):
+        future = Future()
+        if self.fail > 0:
+            self.fail -= 1
+            return future.failure(ValueError('not delivered'))
+        self.messages.append((topic, key, value))
+        return future.success(None)
+
+    def flush(self):
+        pass
+
+
+def test_log_spool(tmp_path):
+    path = str(tmp_path.joinpath('spool'))
+    spool = LogSpool(path, MockLogWriter(), json_encode, segment_size=32, fsync=False, drain_batch=2).open()
+    documents = [{'topic': 't1', 'key': str(key), 'value': {'key': key}} for key in range(5)]
+    assert spool.append(documents[:3], threading.Event()) and spool.append(documents[3:], threading.Event())
+    assert spool.depth()[0] == 3
+    spool.close()
+    log_writer = MockLogWriter(fail=1)
+    spool = LogSpool(path, log_writer, json_encode, fsync=False, retry_delay=0).open()
+    while spool.drain_segment(*spool.cursor):
+        pass
+    # the failed batch is forwarded again as a whole
+    assert [key for _, key, _ in log_writer.messages] == ['1', '2', '0', '1', '2', '3', '4']
+    assert orjson.loads(log_writer.messages[-1][2]) == {'key': 4} and spool.depth() == (1, 0)
+    spool.close()
+
+
+def test_log_spool_large_record(tmp_path):
+    path = str(tmp_path.joinpath('spool'))
+    spool = LogSpool(path, MockLogWriter(), json_encode, segment_size=32, fsync=False).open()
+    documents = [{'topic': 't1', 'key': '0', 'value': {'blob': 'x' * 100}}, {'topic': 't1', 'key': '1', 'value': {}}]
+    assert spool.append(documents[:1], threading.Event()) and spool.append(documents[1:], threading.Event())
+    spool.close()
+    # the record larger than read_size is read whole, the segment is not dropped
+    log_writer = MockLogWriter()
+    spool = LogSpool(path, log_writer, json_encode, fsync=False, read_size=16).open()
+    while spool.drain_segment(*spool.cursor):
+        pass
+    assert [key for _, key, _ in log_writer.messages] == ['0', '1']
+    assert orjson.loads(log_writer.messages[0][2]) == {'blob': 'x' * 100} and spool.depth() == (1, 0)
+    # a large record of the active segment is forwarded too
+    spool.append(documents[:1], threading.Event())
+    assert spool.drain_segment(*spool.cursor) and len(log_writer.messages) == 3
+    spool.close()
+
+
+def test_tick_index():
+    metadata = namedtuple('RecordMetadata', ['topic', 'partition', 'offset'])
+    redis = MockRedis()
+    tick_index = TickIndex(redis, interval=60, max_entries=2)
+    for tick, partition, offset in (('100', 0, 5), ('200', 1, 9)):
+        futures = [Future(), Future()]
+        tick_index.track([{'topic': 't1', 'tick': tick}, {'topic': 't1', 'tick': str(int(tick) + 1)}], futures)
+        for future in futures:
+            future.success(metadata('t1', partition, offset))
+    # a partition is sampled once per interval
+    assert tick_index.store() == 2 and tick_index.store() == 0
+    assert redis.values['t1:tick-index:1'] == {f'{200:020d}:9'.encode()}
+    for tick, offset in (('300', 20), ('400', 30), ('500', 40)):
+        tick_index.sampled = {}
+        tick_index.on_delivery(tick, metadata('t1', 0, offset))
+        tick_index.store()
+    # the oldest checkpoints are trimmed
+    assert redis.values['t1:tick-index:0'] == {f'{400:020d}:30'.encode(), f'{500:020d}:40'.encode()}
+
+
+def test_tick_index_transactions():
+    metadata = namedtuple('RecordMetadata', ['topic', 'partition', 'offset'])
+    tick_index = TickIndex(MockRedis(), interval=0)
+    # the operations of a transaction are published once it is committed, after the operation at 400
+    for ticks, offset in ((('400', '300', '310'), 10), (('320',), 13)):
+        futures = [Future() for _ in ticks]
+        tick_index.track([{'topic': 't1', 'tick': tick} for tick in ticks], futures)
+        futures[0].success(metadata('t1', 0, offset))
+    # the checkpoint of the operation at 320 is after the operation at 400
+    assert tick_index.samples == {('t1', 0): (400, 13)}
+
+
+def test_tick_index_member():
+    # the members are ordered by the tick
+    assert get_tick_index_member('400', 30) == '00000000000000000400:30'
+    assert sorted([get_tick_index_member(1000, 1), get_tick_index_member(999, 2)]) == [
+        '00000000000000000999:2', '00000000000000001000:1']
+    redis = MockRedis({'t1:tick-index:0:lex': [b'00000000000000000300:20']})
+    assert get_tick_offsets(redis, 't1', 2, '400') == {TopicPartition('t1', 0): 20}
+    # the latest member before the tick, exclusive
+    assert redis.values['lex_queries'] == [('t1:tick-index:0', '(00000000000000000400', '-', 0, 1),
+                                           ('t1:tick-index:1', '(00000000000000000400', '-', 0, 1)]
@@ -2,7 +2,8 @@ from copy import deepcopy
 
 import pytest
 
-from replication.consumer.transformer import convert_to_ch_dict_using_schema
+from replication.consumer.transformer import convert_to_ch_dict_using_schema, compile_schema, cast_dict, \
+    compile_columnar_schema, batch_cast_dict
 
 schema = {
     "properties": {
@@ -83,3 +84,50 @@ def test_custom_mapping(doc, expected):
     except Exception as e:
         print(e)
         assert isinstance(e, expected)
+
+
+def test_compiled_schema():
+    cast_dict['int_or_str'] = [int, str]
+    schema_new = deepcopy(schema)
+    schema_new['properties']['Attr1']['type'] = 'int_or_str'
+    schema_new['properties']['Attr3'] = {'type': 'str1', 'ref': 'attr3'}
+    transformer = compile_schema(schema_new)
+    assert transformer({'_key': '1', 'attr1': 'x', 'attr2': '2'}) == {
+        'Id': 1, 'Name': 'temp', 'Attr1': 'x', 'Attr2': 2, 'Attr3': None}
+    assert transformer({'_key': '2', 'attr1': '3', 'attr2': 4, 'attr3': None})['Attr1'] == 3
+    # the missing type cast mapping fails only for the documents having the field
+    with pytest.raises(AttributeError):
+        transformer({'_key': '1', 'attr2': 2, 'attr3': 'y'})
+    del cast_dict['int_or_str']
+
+
+def test_columnar_schema():
+    documents = [{'_key': '1', 'name': 't1', 'attr1': '1', 'attr2': 2}, {'name': 't2', 'attr2': 2},
+                 {'_key': '3', 'attr2': '3'}, {'_key': '4', 'attr1': 'x', 'attr2': 4}]
+    columns, errors = compile_columnar_schema(schema)(documents)
+    assert columns == {'Id': [1, 3], 'Name': ['t1', 'temp'], 'Attr1': [1, 10], 'Attr2': [2, 3]}
+    assert [document for document, _ in errors] == [documents[1], documents[3]]
+    assert 'primary key value is required' in errors[0][1]
+    with pytest.raises(ValueError):
+        compile_columnar_schema(schema)(documents, catch=KeyError)
+
+
+def test_batch_transformer():
+    calls = []
+
+    def upper_batch(values):
+        calls.append(len(values))
+        return [value.upper() for value in values]
+
+    batch_cast_dict['upper'] = upper_batch
+    schema_new = deepcopy(schema)
+    schema_new['properties']['Name']['type'] = 'upper'
+    schema_new['properties']['Email'] = {'type': 'upper', 'ref': 'email'}
+    documents = [{'_key': '1', 'name': 'a', 'attr2': 1, 'email': 'e'}, {'_key': '2', 'attr2': 2},
+                 {'_key': '3', 'name': 3, 'attr2': 3}]
+    columns, errors = compile_columnar_schema(schema_new)(documents)
+    assert columns['Name'] == ['A', 'TEMP'] and columns['Email'] == ['E', None]
+    assert [document for document, _ in errors] == [documents[2]]
+    # the per value form is derived from the batch form
+    assert compile_schema(schema_new)(documents[0])['Name'] == 'A'
+    del batch_cast_dict['upper']
@@ -25,14 +25,18 @@ def prepare_config_loader():
 
 
 # noinspection PyShadowingNames
-def prepare_logger(log_path=None, env='dev'):
+def prepare_logger(log_path=None, env='dev', asynchronous=False):
     if not log_path:
         log_path = str(Path(os.path.realpath(sys.argv[0])).parent.joinpath('logs'))
     mode = 'prod' if env == 'prod' else 'dev'
-    logging = logger.initialize_logger(mode, log_path, mode == 'dev')
+    logging = logger.initialize_logger(mode, log_path, mode == 'dev', asynchronous)
     return logging
 
 
+def is_logger_asynchronous(config):
+    return 'logs' in config and config['logs'].get('asynchronous', False)
+
+
 def prepare_smtp_client(config):
     return get_mail_client(config)
 
@@ -44,8 +48,9 @@ def prepare_optional_smtp_client(config):
 @singleton
 def get_basic_utilities():
     basic_utils = BasicUtils()
-    basic_utils.add((CONFIG, None, None)).add((LOGGER, None, {'env': os.getenv('env')}))
+    basic_utils.add((CONFIG, None, None))
     configs = basic_utils.get(CONFIG)
+    basic_utils.add((LOGGER, None, {'env': os.getenv('env'), 'asynchronous': is_logger_asynchronous(configs)}))
     alert_config = {**configs['alert']['smtp'], 'enabled': configs['alert']['enabled']} if 'smtp' in configs[
         'alert'] else {'enabled': configs['alert']['enabled']}
     basic_utils.add((SMTP_CLIENT, [alert_config], None))
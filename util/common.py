@@ -1,5 +1,8 @@
 from util.basic_utils import get_basic_utilities, CONFIG
 
+# task name of the consumer of the shared collections
+SHARED_CONSUMER = 'shared-consumer'
+
 
 def get_supported_consumers():
     utils = get_basic_utilities()
@@ -9,6 +12,25 @@ def get_supported_consumers():
     return [collection for collection in collections if collection not in exclude]
 
 
+def get_shared_consumers():
+    """ supported consumers that are consumed by the shared consumer """
+    config = get_basic_utilities().get(CONFIG)
+    shared = config['consumer'].get('shared', [])
+    return [consumer for consumer in get_supported_consumers() if consumer in shared]
+
+
+def get_consumer_task(consumer):
+    """ name of the task running the consumer """
+    return SHARED_CONSUMER if consumer in get_shared_consumers() else consumer
+
+
+def get_consumer_tasks():
+    """ names of the consumer tasks, the shared consumers run in one task """
+    shared_consumers = get_shared_consumers()
+    tasks = [consumer for consumer in get_supported_consumers() if consumer not in shared_consumers]
+    return tasks + [SHARED_CONSUMER] if len(shared_consumers) > 0 else tasks
+
+
 def get_supported_producers():
     utils = get_basic_utilities()
     config = utils.get(CONFIG)